@@ -0,0 +1,11 @@
+"""
+code shared by the templates of the grid broker.
+
+The robot loads every template from its own file and only puts the directory of the
+template on the python path. Each template makes this package importable with a single
+line before its grid_common imports, so all the templates use the same modules:
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))  # see grid_common/__init__.py
+
+A robot started with the root of this repository on its PYTHONPATH doesn't need it.
+"""
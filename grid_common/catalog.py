@@ -0,0 +1,93 @@
+import json
+import os
+from collections import namedtuple
+from types import MappingProxyType
+
+
+class ValidationError(ValueError):
+    """
+    raised when a reservation is refused by the catalog, it is refunded right away
+    """
+
+
+class Offer(namedtuple('Offer', ['price', 'cpu', 'memory', 'disk', 'per_size'])):
+    """
+    price per month and resources of a reservation type and size
+    """
+
+    def amount(self, size):
+        return self.price * size if self.per_size else self.price
+
+
+class Catalog:
+    """
+    immutable catalog of the price and resources of every reservation type and size,
+    indexed on (type, size). The size '*' of a type matches any size.
+    A type can restrict the locations it can be deployed on
+    """
+
+    def __init__(self, path):
+        with open(path) as f:
+            catalog = json.load(f)
+
+        offers = {}
+        locations = {}
+        for typ, spec in catalog.items():
+            if 'locations' in spec:
+                locations[typ] = frozenset(spec['locations'])
+            for size, offer in spec['sizes'].items():
+                key = (typ, size if size == '*' else int(size))
+                offers[key] = Offer(
+                    price=float(offer['price']),
+                    cpu=offer.get('cpu', 0),
+                    memory=offer.get('memory', 0),
+                    disk=offer.get('disk', 0),
+                    per_size=offer.get('perSize', False),
+                )
+        self._offers = MappingProxyType(offers)
+        self._locations = MappingProxyType(locations)
+        self._types = frozenset(typ for typ, _ in offers)
+
+    def offer(self, typ, size):
+        offer = self._offers.get((typ, size)) or self._offers.get((typ, '*'))
+        if offer is not None:
+            return offer
+        if typ not in self._types:
+            raise ValidationError("unsupported reservation type %s" % typ)
+        sizes = sorted(str(s) for t, s in self._offers if t == typ)
+        raise ValidationError("size for %s can only be %s" % (typ, " or ".join(sizes)))
+
+    def price(self, typ, size):
+        return self.offer(typ, size).amount(size)
+
+    def check_amount(self, typ, size, duration, tx_amount):
+        amount = self.price(typ, size) * duration
+        if tx_amount < amount:
+            raise ValidationError("transaction amount is to low to deploy the workload. given: %s needed: %s" % (
+                                  tx_amount, amount))
+
+    def check_location(self, typ, location):
+        allowed = self._locations.get(typ)
+        if allowed is not None and location not in allowed:
+            raise ValidationError("can only deploy %s in %s" % (typ, " or ".join(sorted(allowed))))
+
+    def quote(self, reservations):
+        """
+        price a batch of reservations given as (type, size, duration) tuples.
+        returns the list of amounts, None for the reservations the catalog doesn't support
+        """
+        prices = {}
+        amounts = []
+        for typ, size, duration in reservations:
+            key = (typ, size)
+            if key not in prices:
+                try:
+                    prices[key] = self.price(typ, size)
+                except ValidationError:
+                    prices[key] = None
+            price = prices[key]
+            amounts.append(None if price is None else price * duration)
+        return amounts
+
+
+CATALOG = Catalog(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json'))
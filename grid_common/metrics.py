@@ -0,0 +1,162 @@
+import bisect
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+# upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    """
+    cumulative histogram of latencies with fixed buckets
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket counts the values above all bounds
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        upper bound of the bucket holding the q quantile, the largest bound if it is above all bounds
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+    """
+    histograms and counters keyed on their name and labels
+    """
+
+    def __init__(self):
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = defaultdict(int)  # (name, labels) -> value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def inc(self, name, value=1, **labels):
+        self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def summary(self, name):
+        """
+        count and latency quantiles of all the histograms of name, keyed on their labels
+        """
+        summary = {}
+        for (histogram_name, labels), histogram in self._histograms.items():
+            if histogram_name == name:
+                summary[','.join(str(value) for _, value in labels)] = {
+                    'count': histogram.count,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                }
+        return summary
+
+    def counters(self, name):
+        return {
+            ','.join(str(value) for _, value in labels): value
+            for (counter_name, labels), value in self._counters.items() if counter_name == name
+        }
+
+    def dump(self):
+        histograms = []
+        for (name, labels), histogram in self._histograms.items():
+            entry = histogram.to_dict()
+            entry.update(name=name, labels=dict(labels))
+            histograms.append(entry)
+        counters = [
+            {'name': name, 'labels': dict(labels), 'value': value}
+            for (name, labels), value in self._counters.items()
+        ]
+        return {'histograms': histograms, 'counters': counters, 'gauges': []}
+
+
+def prometheus_text(metrics):
+    """
+    render metrics dumped as {'histograms': [...], 'counters': [...], 'gauges': [...]}
+    in the prometheus text exposition format
+    """
+    def labels_text(labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for key, value in sorted(labels.items()))
+
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE %s %s' % (name, kind))
+
+    for histogram in sorted(metrics.get('histograms', []), key=lambda h: h['name']):
+        name, labels = histogram['name'], histogram['labels']
+        declare(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, labels_text(labels, le=bound), cumulative))
+        lines.append('%s_bucket%s %d' % (name, labels_text(labels, le='+Inf'), histogram['count']))
+        lines.append('%s_sum%s %s' % (name, labels_text(labels), repr(float(histogram['sum']))))
+        lines.append('%s_count%s %d' % (name, labels_text(labels), histogram['count']))
+    for kind in ('counters', 'gauges'):
+        for metric in sorted(metrics.get(kind, []), key=lambda m: m['name']):
+            declare(metric['name'], 'counter' if kind == 'counters' else 'gauge')
+            lines.append('%s%s %s' % (metric['name'], labels_text(metric['labels']), metric['value']))
+    return '\n'.join(lines) + '\n'
+
+
+_collectors = OrderedDict()  # name -> function returning the dump of the metrics of a template
+
+
+def register_collector(name, collector):
+    """
+    register the function dumping the metrics of a template
+    as {'histograms': [...], 'counters': [...], 'gauges': [...]},
+    the templates run in the same robot so the grid broker exports them all
+    """
+    _collectors[name] = collector
+
+
+def collect():
+    """
+    dump the metrics of all the registered collectors
+    """
+    metrics = {'histograms': [], 'counters': [], 'gauges': []}
+    for collector in _collectors.values():
+        dump = collector()
+        for kind in metrics:
+            metrics[kind].extend(dump.get(kind, []))
+    return metrics
@@ -0,0 +1,117 @@
+import heapq
+import time
+from collections import defaultdict
+
+from jumpscale import j
+
+from grid_common.metrics import Metrics, register_collector
+
+FARM_SNAPSHOT_TTL = 300  # time after which the nodes of a farm are reloaded from the directory
+
+# latency of the listing of the nodes of a farm
+_metrics = Metrics()
+register_collector('placement', _metrics.dump)
+
+
+def _get_farm_nodes(farmname):
+    """
+    get a list of online nodes in the given farm
+    """
+    with _metrics.time('grid_farm_nodes_seconds'):
+        return list(j.sal_zos.farm.get(farmname).filter_online_nodes())
+
+
+def _placement_key(resources):
+    """
+    create the sort key of the nodes for a placement on the given resources:
+    most remaining capacity first, then the biggest nodes
+    """
+    def key(total, used):
+        return tuple(used[r] - total[r] for r in resources) + tuple(-total[r] for r in resources)
+    return key
+
+
+PLACEMENT_KEYS = {
+    'vm': _placement_key(['cru', 'mru', 'sru']),
+    'sru': _placement_key(['sru']),
+    'hru': _placement_key(['hru']),
+}
+
+
+class FarmNodes:
+    """
+    snapshot of the online nodes of a farm.
+    The resources reserved by the installs done since the snapshot has been loaded
+    are taken from the remaining capacity of the nodes, so consecutive placements
+    spread over the farm before the directory reports the new usage.
+    The node with the most remaining capacity for every placement is kept in a heap.
+    """
+
+    def __init__(self, nodes):
+        self.loaded = time.time()
+        self._nodes = {node['node_id']: node for node in nodes}
+        self._reserved = defaultdict(lambda: defaultdict(int))  # node_id -> resource -> amount
+        self._versions = defaultdict(int)  # node_id -> version, changed on every reservation
+        self._heaps = {}  # placement -> [(key, version, node_id)]
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _key(self, placement, node_id):
+        node = self._nodes[node_id]
+        reserved = self._reserved[node_id]
+        used = defaultdict(int, node['used_resources'])
+        for resource, amount in reserved.items():
+            used[resource] += amount
+        return PLACEMENT_KEYS[placement](defaultdict(int, node['total_resources']), used)
+
+    def least_used(self, placement):
+        """
+        get the detail of the node with the most remaining capacity for the placement,
+        None if the farm has no nodes
+        """
+        heap = self._heaps.get(placement)
+        if heap is None:
+            heap = [(self._key(placement, node_id), self._versions[node_id], node_id) for node_id in self._nodes]
+            heapq.heapify(heap)
+            self._heaps[placement] = heap
+
+        # skip the entries of the nodes that got reserved or excluded since they were pushed
+        while heap and (heap[0][2] not in self._nodes or heap[0][1] != self._versions[heap[0][2]]):
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return self._nodes[heap[0][2]]
+
+    def reserve(self, node_id, **resources):
+        """
+        account resources on a node until the snapshot is reloaded
+        """
+        if node_id not in self._nodes:
+            return
+        for resource, amount in resources.items():
+            self._reserved[node_id][resource] += amount
+        self._versions[node_id] += 1
+        for placement, heap in self._heaps.items():
+            heapq.heappush(heap, (self._key(placement, node_id), self._versions[node_id], node_id))
+
+    def exclude(self, node_id):
+        """
+        stop placing on a node until the snapshot is reloaded, used when the node is out of capacity
+        """
+        self._nodes.pop(node_id, None)
+
+
+_farm_snapshots = {}
+
+
+def farm_nodes(farmname):
+    """
+    get the snapshot of the nodes of a farm, reloaded from the directory every FARM_SNAPSHOT_TTL seconds.
+    The snapshots are shared by all the templates placing workloads on the farms
+    """
+    snapshot = _farm_snapshots.get(farmname)
+    if snapshot is None or time.time() - snapshot.loaded > FARM_SNAPSHOT_TTL:
+        snapshot = FarmNodes(_get_farm_nodes(farmname))
+        _farm_snapshots[farmname] = snapshot
+    return snapshot
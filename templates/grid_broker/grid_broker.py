@@ -1,16 +1,40 @@
 from datetime import date
 from jumpscale import j
-from JumpscaleLib.clients.blockchain.tfchain.TfchainNetwork import TfchainNetwork
 from zerorobot.template.base import TemplateBase
 from zerorobot.service_collection import ServiceConflictError
-from nacl.signing import VerifyKey, SigningKey
+from zerorobot.template.state import StateCheckError
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore, Semaphore
+from gevent.pool import Group, Pool
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict
+from string import Formatter
 
+import bisect
+import gevent
+import os
 import time
-import requests
+import random
 import base64
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))  # see grid_common/__init__.py
+
+from grid_common.catalog import CATALOG, ValidationError
+from grid_common.metrics import Histogram, Metrics, collect, prometheus_text
 
 RESERVATION_UID = 'github.com/threefoldtech/grid_broker/reservation/0.0.1'
 NOTARY_URL = 'https://notary.grid.tf'
+NOTARY_TIMEOUT = 10  # timeout in seconds of a single request to the notary
+NOTARY_RETRIES = 3
+REORG_WINDOW = 10  # amount of blocks the watcher looks back behind its cursor
+TX_ID_SIZE = 32  # size in bytes of a transaction id
+EXPLORER_TIMEOUT = 10  # timeout in seconds of a chain height request to the explorer
+WATCH_TICK = 2  # time in seconds between two checks of the watch scheduler
+WATCH_MIN_INTERVAL = 10  # interval in seconds between chain height polls right after activity
+WATCH_MAX_INTERVAL = 60  # interval the polls back off to while there are no new transactions
+DAY = 86400
+REFUND_RETENTION = 30 * DAY  # time the payout of a refund is kept after it is paid
 
 
 class GridBroker(TemplateBase):
@@ -20,10 +44,54 @@ class GridBroker(TemplateBase):
 
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
-        self._tfchain_client = j.clients.tfchain.get(self.data['wallet'])
+        self._tfchain_client_ = None
         self._wallet_ = None
         self._watcher_ = None
-        self.recurring_action(self._watch_transactions, 60)
+        self._explorers_ = None
+        self._processed_ = None
+        self._sendgrid_ = None
+        self._reservations_ = None
+        self._refunds = RefundQueue.load(self.data.get('refunds'))
+        self._metrics = Metrics()
+        self._explorer_ = None
+        self._scheduler = WatchScheduler(WATCH_MIN_INTERVAL, WATCH_MAX_INTERVAL)
+        self._watch_lock = Semaphore()
+        self._in_flight = set()
+        self._threebot_keys = TTLCache(self.data['threebotCacheTTL'], self.data['threebotCacheSize'])
+        self._threebot_records = TTLCache(self.data['threebotCacheTTL'], self.data['threebotCacheSize'])
+        self._key_material = TTLCache(self.data['threebotCacheTTL'], self.data['threebotCacheSize'])
+        self._notary = NotaryClient(NOTARY_URL, concurrency=self.data['parseConcurrency'], metrics=self._metrics)
+        self._pipeline = Pipeline({
+            'parse': self.data['parseConcurrency'],
+            'deploy': self.data['deployConcurrency'],
+            'notify': self.data['notifyConcurrency'],
+        })
+        self.recurring_action(self._watch_tick, WATCH_TICK)
+
+    def update_data(self, data):
+        wallet_changed = data.get('wallet', self.data['wallet']) != self.data['wallet']
+        self.data.update(data)
+        if wallet_changed:
+            # the keys of the previous wallet must not be used anymore
+            self._tfchain_client_ = None
+            self._wallet_ = None
+            self._watcher_ = None
+            self._explorers_ = None
+            self._key_material.invalidate()
+            # the cursor and the processed transactions belong to the previous wallet,
+            # the new one is watched from its minimum height
+            self.data['lastHeight'] = self.data['minHeight']
+            self.data.pop('processed', None)
+            self._processed_ = ProcessedTransactions()
+            self.data['processedTransactions'] = self._processed_.dump()
+            self._scheduler = WatchScheduler(WATCH_MIN_INTERVAL, WATCH_MAX_INTERVAL)
+
+    @property
+    def _tfchain_client(self):
+        # the tfchain client is only loaded once the broker needs its wallet
+        if self._tfchain_client_ is None:
+            self._tfchain_client_ = j.clients.tfchain.get(self.data['wallet'])
+        return self._tfchain_client_
 
     @property
     def _wallet(self):
@@ -34,19 +102,166 @@ class GridBroker(TemplateBase):
     @property
     def _watcher(self):
         if self._watcher_ is None:
-            self._watcher_ = TransactionWatcher(self._wallet, self.data['minHeight'])
+            self._watcher_ = TransactionWatcher(
+                self._wallet, self.data['minHeight'], self.data.get('lastHeight', 0))
         return self._watcher_
 
+    @property
+    def _processed(self):
+        if self._processed_ is None:
+            if 'processed' in self.data:
+                # migrate the legacy dict of processed transaction ids
+                self._processed_ = ProcessedTransactions.from_legacy(self.data.pop('processed'))
+                self.data['processedTransactions'] = self._processed_.dump()
+            else:
+                self._processed_ = ProcessedTransactions.load(self.data.get('processedTransactions'))
+        return self._processed_
+
+    @property
+    def _reservations(self):
+        if self._reservations_ is None:
+            # built once from the reservation services, then updated incrementally
+            index = ReservationIndex()
+            index.rebuild(
+                (s.name, s.data, _is_cleaned(s)) for s in self.api.services.find(template_uid=RESERVATION_UID))
+            self._reservations_ = index
+        return self._reservations_
+
+    def _mark_processed(self, tx):
+        self._processed.add(tx.id, getattr(tx, 'height', 0))
+        self.data['processedTransactions'] = self._processed.dump()
+
+    def new_block(self, height=None):
+        """
+        notify the broker that a new block was added to the chain,
+        its transactions are listed at the next tick of the watch scheduler
+        """
+        self._scheduler.notify(height)
+
+    def _watch_tick(self):
+        if self._watch_lock.locked() or not self._scheduler.due(time.time()):
+            return
+
+        height = None if self._scheduler.notified else self._chain_height()
+        if not self._scheduler.should_list(height):
+            # no new block, don't list the transactions of the wallet
+            self._scheduler.done(time.time(), height, False)
+            return
+
+        count = None
+        try:
+            count = self._watch_transactions()
+        finally:
+            # a failed watch backs off like an idle one, its blocks are listed again at the next poll
+            self._scheduler.done(time.time(), height, bool(count), listed=count is not None)
+
+    @property
+    def _explorer(self):
+        # the http session is only created once the broker polls the chain height
+        if self._explorer_ is None:
+            import requests
+            self._explorer_ = requests.Session()
+        return self._explorer_
+
+    @property
+    def _explorers(self):
+        # the explorers of the network of the wallet
+        if self._explorers_ is None:
+            from JumpscaleLib.clients.blockchain.tfchain.TfchainNetwork import TfchainNetwork
+            config = self._tfchain_client.config.data
+            self._explorers_ = config.get('explorers') or TfchainNetwork(config['network']).official_explorers()
+        return self._explorers_
+
+    def _chain_height(self):
+        """
+        get the current height of the chain from the explorers, None if none can be reached
+        """
+        for url in self._explorers:
+            try:
+                response = self._explorer.get(url + '/explorer', timeout=EXPLORER_TIMEOUT)
+                response.raise_for_status()
+                return response.json()['height']
+            except Exception as err:
+                self.logger.warning("fail to get the chain height from %s: %s", url, str(err))
+        return None
+
     def _watch_transactions(self):
-        if 'processed' not in self.data:
-            self.data['processed'] = {}
-        self.logger.info("look for new incoming transactions")
+        """
+        process the new transactions of the wallet, returns the amount of new transactions
+        """
+        # never let overlapping ticks pick up the same transactions
+        if not self._watch_lock.acquire(blocking=False):
+            self.logger.info("previous watch still running, skipping")
+            return
 
-        for tx in self._watcher.watch():
-            if self.data['processed'].get(tx.id, False):
-                self.logger.info("tx %s already processed", tx.id)
-                continue
-            # try to parse the transaction data
+        try:
+            self.logger.info("look for new incoming transactions")
+
+            txns = []
+            for tx in self._watcher.watch():
+                if tx.id in self._processed:
+                    self.logger.info("tx %s already processed", tx.id)
+                    # move the transaction to its block once it got confirmed
+                    self._mark_processed(tx)
+                    continue
+                if tx.id in self._in_flight:
+                    self.logger.info("tx %s already being processed", tx.id)
+                    continue
+                self._in_flight.add(tx.id)
+                txns.append(tx)
+
+            # load the notary data of all the new transactions at once,
+            # data that is not a valid key is left to the parse stage which refunds it
+            keys = []
+            for tx in txns:
+                if not tx.data:
+                    continue
+                try:
+                    keys.append(tx.data.decode('utf-8'))
+                except UnicodeDecodeError:
+                    continue
+            self._notary.prefetch(keys)
+
+            # extensions wait for the new reservations of the same watch they might extend
+            creations = CreationBarrier(tx.id for tx in txns)
+            group = Group()
+            for tx in txns:
+                group.spawn(self._process_transaction, tx, creations)
+            group.join()
+            self._notary.clear()
+            # pay all the refunds decided during this watch at once
+            self._pay_refunds()
+
+            # only reached when all transactions returned by the watcher have been handled
+            if self.data.get('lastHeight', 0) != self._watcher.height:
+                self.data['lastHeight'] = self._watcher.height
+                # transactions below the start of the next watch will never be listed again
+                self._processed.prune(self._watcher.start_height())
+                self.data['processedTransactions'] = self._processed.dump()
+                self.save()
+            return len(txns)
+        finally:
+            # the transactions of a failed watch are listed again by the next one
+            self._in_flight.clear()
+            self._watch_lock.release()
+
+    def _process_transaction(self, tx, creations=None):
+        """
+        run a transaction through the parse, deploy and notify stages of the pipeline
+        """
+        try:
+            self._process_stages(tx, creations)
+        finally:
+            # even if a deploy errors, we refund so it is considered processed
+            self.logger.info("done processing transaction %s", tx.id)
+            self._mark_processed(tx)
+            self._in_flight.discard(tx.id)
+            if creations is not None:
+                creations.arrive(tx.id)
+
+    def _process_stages(self, tx, creations=None):
+        # try to parse the transaction data
+        with self._pipeline.stage('parse'):
             try:
                 threebot_id, data = self._parse_tx_data(tx)
                 # refund if there is not data
@@ -55,19 +270,24 @@ class GridBroker(TemplateBase):
             except Exception as err:
                 # malformed or empty data, refund transaction, though we can't notify the person that this happened
                 self.logger.info("error parsing transaction data of tx %s: %s", tx.id, str(err))
+                self._metrics.inc('grid_broker_transactions_total', outcome='failed', type='unknown')
                 try:
                     self._refund(tx)
+                    self._metrics.inc('grid_broker_transactions_total', outcome='refunded', type='unknown')
                 except Exception as refund_err:
                     self.logger.error("fail to refund transaction %s: %s", tx.id, str(refund_err))
+                return
 
-                self.logger.info("done processing transaction %s", tx.id)
-                self.data['processed'][tx.id] = True
-                continue
+        # add webgateway we want to use
+        data['webGateway'] = self.data['webGateway']
 
-            # add webgateway we want to use
-            data['webGateway'] = self.data['webGateway']
+        if creations is not None and data.get("type") == "extension":
+            # wait outside of the deploy stage, so the reservations it waits for can take its place
+            creations.arrive(tx.id)
+            creations.wait()
 
-            # try to deploy the reservation
+        # try to deploy the reservation
+        with self._pipeline.stage('deploy'):
             try:
                 if data["type"] == "extension":
                     action = "extend"
@@ -76,11 +296,12 @@ class GridBroker(TemplateBase):
 
                     expiry_date, res_type = self._extend_reservation(tx, data, threebot_id)
 
-                    self._notify_user(
-                        data['email'],
-                        "Reservation extended",
-                        _extend_template.format(tx_id=data["transaction_id"], expiry=expiry_date, type=res_type)
-                    )
+                    def notify():
+                        self._notify_user(
+                            data['email'],
+                            "Reservation extended",
+                            _email_templates.render('extend', {'tx_id': data["transaction_id"], 'expiry': expiry_date, 'type': res_type})
+                        )
                 else:
                     action = "complete"
                     action_type = "reservation"
@@ -89,37 +310,114 @@ class GridBroker(TemplateBase):
                     info = self._deploy(tx, data, threebot_id)
 
                     self.logger.info("transaction processed %s", tx.id)
-                    # insert connection info into mail
-                    if info:
-                        self._send_connection_info(data['email'], info)
+
+                    def notify():
+                        # insert connection info into mail
+                        if info:
+                            self._send_connection_info(data['email'], info)
+                self._metrics.inc('grid_broker_transactions_total', outcome='processed', type=data['type'])
             except Exception as err:
                 self.logger.error("error processing transation %s: %s", tx.id, str(err))
+                error = str(err)
+                self._metrics.inc('grid_broker_transactions_total', outcome='failed', type=data.get('type', 'unknown'))
 
                 refund_status = "failed to refund"
                 try:
                     self._refund(tx)
-                    refund_status = "was refunded"
+                    refund_status = "will be refunded"
+                    self._metrics.inc('grid_broker_transactions_total', outcome='refunded', type=data.get('type', 'unknown'))
                 except Exception as refund_err:
                     self.logger.error("fail to refund transaction %s: %s", tx.id, str(refund_err))
 
-                self._notify_user(
-                    data['email'],
-                    title,
-                    _refund_template.format(address=tx.from_addresses[0], error=str(err), tx_id=tx.id, action=action, type=action_type, refund_status=refund_status)
-                )
-            finally:
-                # even if a deploy errors, we refund so it is considered processed
-                self.logger.info("done processing transaction %s", tx.id)
-                self.data['processed'][tx.id] = True
+                def notify():
+                    self._notify_user(
+                        data['email'],
+                        title,
+                        _email_templates.render('refund', {'address': tx.from_addresses[0], 'error': error, 'tx_id': tx.id, 'action': action, 'type': action_type, 'refund_status': refund_status})
+                    )
+
+        if creations is not None:
+            creations.arrive(tx.id)
+
+        with self._pipeline.stage('notify'):
+            try:
+                notify()
+            except Exception as err:
+                self.logger.error("fail to notify user of transaction %s: %s", tx.id, str(err))
+
+    def metrics(self):
+        """
+        return the queue depth and latency of every stage of the transaction pipeline
+        """
+        metrics = self._pipeline.metrics()
+        metrics['inFlight'] = len(self._in_flight)
+        metrics['threebotKeys'] = self._threebot_keys.stats()
+        metrics['threebotRecords'] = self._threebot_records.stats()
+        metrics['processed'] = len(self._processed)
+        metrics['refundsPending'] = self._refunds.pending()
+        metrics['stages'] = self._metrics.summary('grid_broker_stage_seconds')
+        metrics['transactions'] = self._metrics.counters('grid_broker_transactions_total')
+        return metrics
+
+    def prometheus(self):
+        """
+        export the metrics of the broker, the reservations and the sendgrid client in the prometheus text format
+        """
+        metrics = self._metrics.dump()
+        metrics['gauges'].extend(self._gauges())
+
+        # read in process, a scrape never waits for the actions queued on the other services
+        try:
+            for kind, entries in collect().items():
+                metrics[kind].extend(entries)
+        except Exception as err:
+            self.logger.error("fail to collect the metrics of the other templates: %s", str(err))
+
+        return prometheus_text(metrics)
+
+    def _gauges(self):
+        gauges = [
+            ('grid_broker_in_flight_transactions', {}, len(self._in_flight)),
+            ('grid_broker_processed_transactions', {}, len(self._processed)),
+            ('grid_broker_pending_refunds', {}, self._refunds.pending()),
+            ('grid_broker_cache_entries', {'cache': 'threebot_keys'}, self._threebot_keys.stats()['size']),
+            ('grid_broker_cache_entries', {'cache': 'threebot_records'}, self._threebot_records.stats()['size']),
+        ]
+        for stage, stats in self._pipeline.metrics().items():
+            gauges.append(('grid_broker_stage_queued', {'stage': stage}, stats['queued']))
+            gauges.append(('grid_broker_stage_running', {'stage': stage}, stats['running']))
+        if self._reservations_ is not None:
+            gauges.append(('grid_broker_indexed_reservations', {}, len(self._reservations_)))
+        return [{'name': name, 'labels': labels, 'value': value} for name, labels, value in gauges]
+
+    def index_reservation(self, name, data, cleaned=False):
+        """
+        update the entry of a reservation in the reservation index
+        """
+        self._reservations.update(name, reservation_record(data, cleaned))
+
+    def query_reservations(self, type=None, location=None, email=None, threebot_id=None, state=None,
+                           expires_after=None, expires_before=None, page=1, page_size=100):
+        """
+        list a page of the reservations matching all the given filters, ordered by expiry,
+        with the total amount paid per reservation type of all the matching reservations
+        """
+        filters = {'type': type, 'location': location, 'email': email, 'threebotId': threebot_id, 'state': state}
+        filters = {key: value for key, value in filters.items() if value is not None}
+        return self._reservations.query(filters, expires_after, expires_before, page, page_size)
 
     def _extend_reservation(self, tx, data, threebot_id):
         self.logger.info(
             "start processing transaction %s - %s", tx.id, tx.data)
-        bot_expiration = j.clients.tfchain.threebot.get_record(
-            threebot_id, TfchainNetwork(self._tfchain_client.config.data["network"])).expiration_timestamp
-
         s = self.api.services.get(template_uid=RESERVATION_UID, name=data["transaction_id"])
-        task = s.schedule_action('extend', {"duration": data["duration"], "bot_expiration": bot_expiration, "tx_amount": data["amount"]}).wait(die=True)
+        _check_duration(data["duration"])
+        CATALOG.check_amount(s.data["type"], s.data["size"], data["duration"], data["amount"])
+        expiry = j.clients.tfchain.time.extend(s.data["expiryTimestamp"], data["duration"])
+        bot_expiration = self._get_3bot_expiration(threebot_id, expiry)
+
+        with self._metrics.time('grid_broker_stage_seconds', stage='extend', type=s.data['type']):
+            task = s.schedule_action('extend', {"duration": data["duration"], "bot_expiration": bot_expiration, "tx_amount": data["amount"]}).wait(die=True)
+        self._reservations.update(s.name, reservation_record(s.data))
         expiry_date = date.fromtimestamp(task.result["expiryTimestamp"])
 
         return expiry_date.strftime("%d/%m/%y"), task.result["type"]
@@ -128,17 +426,22 @@ class GridBroker(TemplateBase):
         self.logger.info(
             "start processing transaction %s - %s", tx.id, tx.data)
 
+        # refuse invalid reservations before anything is created for them
+        _validate_reservation(data)
+
         data["creationTimestamp"] = time.time()
         data["expiryTimestamp"] = j.clients.tfchain.time.extend(data["creationTimestamp"], data["duration"])
 
         # check if the reservation expiration exceeds the 3bot expiration before creating the reservation
-        bot_expiration = j.clients.tfchain.threebot.get_record(
-            threebot_id, TfchainNetwork(self._tfchain_client.config.data["network"])).expiration_timestamp
+        bot_expiration = self._get_3bot_expiration(threebot_id, data["expiryTimestamp"])
         if date.fromtimestamp(data["expiryTimestamp"]) > date.fromtimestamp(bot_expiration):
-            raise ValueError("Reservation expiration can't exceed 3bot expiration")
+            raise ValidationError("Reservation expiration can't exceed 3bot expiration")
 
+        data["threebotId"] = str(threebot_id)
         s = self.api.services.find_or_create(RESERVATION_UID, tx.id, data)
-        task = s.schedule_action('install').wait(die=True)
+        with self._metrics.time('grid_broker_stage_seconds', stage='install', type=data['type']):
+            task = s.schedule_action('install').wait(die=True)
+        self._reservations.update(s.name, reservation_record(s.data))
         info = task.result
         expiry_date = date.fromtimestamp(data["expiryTimestamp"])
         info["expiry"] = expiry_date.strftime("%d/%m/%y")
@@ -146,46 +449,61 @@ class GridBroker(TemplateBase):
         return info
 
     def _refund(self, tx):
+        """
+        queue the refund of a transaction, it is paid at the end of the watch
+        """
         if not tx.amount > DEFAULT_MINERFEE:
             self.logger.info("not refunding tx %s, amount too low", tx.id)
-        self.logger.info("refunding tx %s to %s", tx.id, tx.from_addresses[0])
-        self._wallet.send_money((tx.amount - DEFAULT_MINERFEE)/TFT_PRECISION, tx.from_addresses[0])
+            raise ValueError("amount of transaction %s is too low to be refunded" % tx.id)
+        self.logger.info("queue refund of tx %s to %s", tx.id, tx.from_addresses[0])
+        self._refunds.add(tx.id, tx.from_addresses[0], tx.amount)
+        # pending refunds must survive a restart
+        self.data['refunds'] = self._refunds.dump()
+        self.save()
+
+    def _pay_refunds(self):
+        """
+        pay the pending refunds, with a single transaction per address
+        """
+        for address, amount, tx_ids in self._refunds.payouts():
+            self.logger.info("refunding tx %s to %s", ', '.join(tx_ids), address)
+            try:
+                payout = self._wallet.send_money(amount / TFT_PRECISION, address)
+            except Exception as err:
+                # stays pending and is retried at the end of the next watch
+                self.logger.error("fail to refund to %s: %s", address, str(err))
+                continue
+            self._refunds.paid(tx_ids, str(getattr(payout, 'id', payout)))
+            self.data['refunds'] = self._refunds.dump()
+            self.save()
+
+        if self._refunds.prune(time.time() - REFUND_RETENTION):
+            self.data['refunds'] = self._refunds.dump()
+            self.save()
 
     def _send_connection_info(self, email, data):
-        if data['type'] == 'vm':
-            self._notify_user(
-                email,
-                "Your virtual 0-OS is ready on the Threefold grid",
-                _vm_template.format(**data)
-            )
-        elif data['type'] == 's3':
-            self._notify_user(
-                email,
-                "Your S3 archive server is ready on the Threefold grid",
-                _s3_template.format(**data)
-            )
-        elif data['type'] == 'namespace':
-            self._notify_user(
-                email,
-                "Your 0-DB namespace is ready on the Threefold grid",
-                _namespace_template.format(**data)
-            )
-        elif data['type'] == 'reverse_proxy':
-            self._notify_user(
-                email,
-                'Your reverse proxy is ready on the Threefold grid',
-                _proxy_template.format(**data),
-            )
-        else:
-            self.logger.error("Can't send connection info for %s", data[0])
+        subject = CONNECTION_INFO_SUBJECTS.get(data['type'])
+        if subject is None:
+            self.logger.error("Can't send connection info for %s", data['type'])
+            return
+        self._notify_user(email, subject, _email_templates.render(data['type'], data))
+
+    @property
+    def _sendgrid(self):
+        if self._sendgrid_ is None:
+            clients = self.api.services.find(template_name='sendgrid_client')
+            if clients:
+                self._sendgrid_ = clients[0]
+        return self._sendgrid_
 
     def _notify_user(self, receiver, subject, content):
-        clients = self.api.services.find(template_name='sendgrid_client')
-        if not clients:
+        client = self._sendgrid
+        if client is None:
             self.logger.warning("there is no sendgrid client configured on the robot. cannot send email")
             return
 
-        client = clients[0]
+        # the email is queued in the outbox of the sendgrid client, which sends it in batches
+        # and records its delivery latency
         client.schedule_action('send', {
             'sender': 'broker@grid.tf',
             'receiver': receiver,
@@ -222,14 +540,13 @@ class GridBroker(TemplateBase):
             return
 
         # decrypt data
-        signing_key = self._wallet.private_key(tx.to_address)
-        if not signing_key:
+        box = self._get_decryption_box(tx.to_address, data['threebot_id'], verification_key)
+        if box is None:
             self.logger.info("fail to get signing key for transaction %s", tx.id)
             return
-        # ed25519 private keys actually hold an appended copy of the pub key, we only care for the first 32 bytes
-        signing_key = SigningKey(signing_key[:32])
 
-        decrypted_data = self._decrypt_data(verification_key, signing_key, data['content'])
+        with self._metrics.time('grid_broker_stage_seconds', stage='decrypt'):
+            decrypted_data = box.decrypt(data['content'])
         data_dict = j.data.serializer.msgpack.loads(decrypted_data)
         data_dict['txId'] = tx.id
         data_dict['amount'] = tx.amount
@@ -240,10 +557,7 @@ class GridBroker(TemplateBase):
         get data from the notary associated with a key. The key is assumed to be in hex form
         """
         # we should always be able to reach the notary so don't catch an error
-        response = requests.get('{}/get?hash={}'.format(NOTARY_URL, key), timeout=30)
-        if response.status_code != 200:
-            return None
-        return response.json()
+        return self._notary.get(key)
 
     def _verify_signature(self, verification_key, content, signature):
         """
@@ -251,177 +565,790 @@ class GridBroker(TemplateBase):
         returns content if verification is successful, None otherwise
         """
         try:
-            return j.data.nacl.verify_ed25519(content, signature, verification_key)
+            with self._metrics.time('grid_broker_stage_seconds', stage='verify'):
+                return j.data.nacl.verify_ed25519(content, signature, verification_key)
         except:
             return None
 
-    def _decrypt_data(self, verification_key, signing_key, content):
+    def _get_decryption_box(self, address, threebot_id, verification_key):
         """
-        Decrypt data by converting a verfication key and signing key to their respective
-        curve25519 public/private keys. verification and signing key are instances of
-        nacl.signing.(VerifyKey|SigningKey). Content is assumed to be in byte form
+        get the box to decrypt the data sent by a 3bot to one of our addresses.
+        Boxes are only kept in memory and reused for all the reservations
+        of the same 3bot to the same address
         """
-        private_key = j.data.nacl.signing_key_to_private_key(signing_key)
-        public_key = j.data.nacl.verify_key_to_public_key(verification_key)
-        decrypted_content = j.data.nacl.decrypt_curve25519(content, private_key, public_key)
-        return decrypted_content
+        def load():
+            signing_key = self._wallet.private_key(address)
+            if not signing_key:
+                return None
+            from nacl.signing import SigningKey
+            # ed25519 private keys actually hold an appended copy of the pub key, we only care for the first 32 bytes
+            return decryption_box(verification_key, SigningKey(signing_key[:32]))
+
+        # the verification key is part of the key so a new 3bot key is never decrypted with an old box
+        key = (address, threebot_id, bytes(verification_key))
+        box = self._key_material.get(key, load)
+        if box is None:
+            self._key_material.invalidate(key)
+        return box
 
     def _get_3bot_key(self, id):
         """
         get the key from the 3bot with the given id
         """
-        key = self._wallet.get_3bot_key(id)
+        return self._threebot_keys.get(id, lambda: self._load_3bot_key(id))
+
+    def _load_3bot_key(self, id):
+        with self._metrics.time('grid_broker_stage_seconds', stage='threebot_key'):
+            key = self._wallet.get_3bot_key(id)
         algo, key = key.split(':')
         if algo != 'ed25519':
             return None
+        from nacl.signing import VerifyKey
         keybytes = bytes.fromhex(key)
         return VerifyKey(keybytes)
 
+    def _get_3bot_expiration(self, id, expiry=None):
+        """
+        get the expiration timestamp of the record of the 3bot with the given id
+        if expiry is given and the cached expiration is close to it, the record is reloaded
+        since the 3bot might have been extended in the meantime
+        """
+        def load():
+            from JumpscaleLib.clients.blockchain.tfchain.TfchainNetwork import TfchainNetwork
+            with self._metrics.time('grid_broker_stage_seconds', stage='threebot_record'):
+                return j.clients.tfchain.threebot.get_record(
+                    id, TfchainNetwork(self._tfchain_client.config.data["network"])).expiration_timestamp
+
+        expiration = self._threebot_records.get(id, load)
+        if expiry is not None and expiration < expiry + DAY:
+            self._threebot_records.invalidate(id)
+            expiration = self._threebot_records.get(id, load)
+        return expiration
+
+
+def _check_duration(duration):
+    if not isinstance(duration, int) or duration < 1:
+        raise ValidationError("invalid reservation duration %s" % duration)
+
+
+def _validate_reservation(data):
+    """
+    check the price, type, size and location of a new reservation
+    """
+    typ = data.get('type')
+    size = data.get('size')
+    _check_duration(data.get('duration'))
+    CATALOG.check_amount(typ, size, data['duration'], data['amount'])
+
+    if typ != 'reverse_proxy':
+        location = data.get('location')
+        if not isinstance(location, str) or not location or location != location.strip():
+            raise ValidationError("invalid reservation location %s" % location)
+        CATALOG.check_location(typ, location)
+
+    if typ == 'namespace':
+        if data.get('disk_type') not in (1, 2):
+            raise ValidationError("invalid namespace disk type %s" % data.get('disk_type'))
+        if data.get('mode') not in (1, 2, 3):
+            raise ValidationError("invalid namespace mode %s" % data.get('mode'))
+    elif typ == 'reverse_proxy':
+        if not data.get('domain') or not data.get('backend_urls'):
+            raise ValidationError("reverse proxy needs a domain and backend urls")
+
+
+class CreationBarrier:
+    """
+    lets the extensions of a watch wait until the other transactions of the watch,
+    which might create the reservations they extend, are deployed or known to be no creation
+    """
+
+    def __init__(self, tx_ids):
+        self._pending = set(tx_ids)
+        self._done = Event()
+        if not self._pending:
+            self._done.set()
+
+    def arrive(self, tx_id):
+        self._pending.discard(tx_id)
+        if not self._pending:
+            self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+
+class WatchScheduler:
+    """
+    decides when the broker lists the transactions of its wallet.
+    The chain height is polled every interval, the interval is reset to min_interval
+    when new transactions were found and doubled up to max_interval otherwise.
+    The transactions are only listed when the height advanced, the height is unknown
+    or a new block was notified
+    """
+
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.height = None  # chain height of the last listing
+        self.notified = False
+        self._notified_height = None
+        self._next = 0
+
+    def notify(self, height=None):
+        if height is None or self.height is None or height > self.height:
+            self.notified = True
+            self._notified_height = height
+
+    def due(self, now):
+        return self.notified or now >= self._next
+
+    def should_list(self, height):
+        return self.notified or height is None or self.height is None or height > self.height
+
+    def done(self, now, height, active, listed=True):
+        """
+        schedule the next poll, active tells if new transactions were found,
+        listed if the transactions up to height were handled
+        """
+        if height is None:
+            height = self._notified_height
+        self.notified = False
+        self._notified_height = None
+        if height is not None and listed:
+            self.height = max(self.height or 0, height)
+        self.interval = self.min_interval if active else min(self.max_interval, self.interval * 2)
+        self._next = now + self.interval
+
 
 class TransactionWatcher:
+    """
+    TransactionWatcher keeps a cursor on the last block height it has fully processed
+    so every call to watch only lists the transactions of the new blocks.
+    The cursor is moved back by reorg_window blocks when listing to be safe against
+    small chain reorganisations, transactions seen twice are filtered by the broker.
+    """
 
-    def __init__(self, wallet, min_blockheight=0):
+    def __init__(self, wallet, min_blockheight=0, last_height=0, reorg_window=REORG_WINDOW):
         self._wallet = wallet
         self._min_height = min_blockheight
+        self._reorg_window = reorg_window
+        self._addresses = None
+        self.height = max(min_blockheight, last_height)
+
+    def start_height(self):
+        return max(self._min_height, self.height - self._reorg_window)
 
     def watch(self):
-        txns = self._wallet.list_incoming_transactions(min_height=self._min_height)
+        txns = self._wallet.list_incoming_transactions(min_height=self.start_height())
         txns.reverse()
-        try:
-            for tx in txns:
-                if self._is_locked(tx):
-                    continue
-                # ignore the returned output to ourselves if we send money to someone else
-                to_self = False
-                for address in tx.from_addresses:
-                    if address in self._wallet.addresses:
-                        to_self = True
-                        break
-                if to_self:
-                    continue
-                yield tx
-        except IndexError:
-            return
+        selected, height = self.filter(txns)
+        for tx in selected:
+            yield tx
+
+        # all transactions have been handled, move the cursor
+        self.height = max(self.height, height)
+
+    def filter(self, txns):
+        """
+        select the transactions that need to be processed, skipping the locked ones
+        and the outputs returned to ourselves when we send money to someone else.
+        Transactions the wallet fails to read are skipped and, like the locked ones,
+        keep the cursor below them so they are listed again.
+        returns the selected transactions and the height the cursor can move to once they are processed
+        """
+        own_addresses = self._own_addresses()
+        selected = []
+        height = self.height
+        # lowest height of a transaction we need to see again in a later watch
+        pending = None
+        for tx in txns:
+            # unconfirmed transactions have no height and must not move the cursor
+            tx_height = getattr(tx, 'height', 0) or 0
+            try:
+                locked = self._is_locked(tx)
+                own = not own_addresses.isdisjoint(tx.from_addresses)
+            except IndexError:
+                locked = True
+            if locked:
+                if tx_height and (pending is None or tx_height < pending):
+                    pending = tx_height
+                continue
+            if not own:
+                selected.append(tx)
+            height = max(height, tx_height)
+
+        if pending is not None:
+            height = min(height, pending - 1)
+        return selected, height
+
+    def _own_addresses(self):
+        """
+        snapshot of the addresses of our wallet, only refreshed when new addresses are generated
+        """
+        addresses = self._wallet.addresses
+        if self._addresses is None or len(addresses) != len(self._addresses):
+            self._addresses = frozenset(addresses)
+        return self._addresses
 
     def _is_locked(self, tx):
         return tx._locked
 
 
+def _is_cleaned(reservation):
+    if reservation.data.get('cleanedTimestamp'):
+        return True
+    try:
+        reservation.state.check('actions', 'cleanup', 'ok')
+        return True
+    except StateCheckError:
+        return False
+
+
+def decryption_box(verification_key, signing_key):
+    """
+    create a box to decrypt data by converting a verfication key and signing key to their respective
+    curve25519 public/private keys. verification and signing key are instances of
+    nacl.signing.(VerifyKey|SigningKey)
+    """
+    from nacl.public import Box
+    private_key = signing_key.to_curve25519_private_key()
+    public_key = verification_key.to_curve25519_public_key()
+    return Box(private_key, public_key)
+
+
+class NotaryClient:
+    """
+    client of the notary that keeps a pool of keep-alive connections
+    and can prefetch the data of many keys concurrently.
+    Every request to the notary and every prefetch is timed in metrics
+    """
+
+    def __init__(self, url=NOTARY_URL, timeout=NOTARY_TIMEOUT, retries=NOTARY_RETRIES, backoff=1, concurrency=10,
+                 metrics=None):
+        self._url = url
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._concurrency = concurrency
+        self._prefetched = {}
+        self._metrics = metrics or Metrics()
+        self._session_ = None
+
+    @property
+    def _session(self):
+        # requests is only loaded once the notary is used
+        if self._session_ is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            self._session_ = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._concurrency)
+            self._session_.mount('http://', adapter)
+            self._session_.mount('https://', adapter)
+        return self._session_
+
+    def get(self, key):
+        """
+        get the data associated with a key, None if the notary doesn't know the key
+        """
+        if key in self._prefetched:
+            return self._prefetched.pop(key)
+        return self._fetch(key)
+
+    def prefetch(self, keys):
+        """
+        fetch the data of all keys concurrently, so the next get of these keys doesn't hit the notary.
+        keys that fail to be fetched are fetched again on get
+        """
+        import requests
+
+        def fetch(key):
+            try:
+                self._prefetched[key] = self._fetch(key)
+            except requests.exceptions.RequestException:
+                pass
+
+        with self._metrics.time('grid_broker_stage_seconds', stage='notary_prefetch'):
+            pool = Pool(self._concurrency)
+            for key in set(keys):
+                if key not in self._prefetched:
+                    pool.spawn(fetch, key)
+            pool.join()
+
+    def clear(self):
+        self._prefetched.clear()
+
+    def _fetch(self, key):
+        with self._metrics.time('grid_broker_stage_seconds', stage='notary'):
+            return self._request(key)
+
+    def _request(self, key):
+        import requests
+        for attempt in range(self._retries + 1):
+            last = attempt == self._retries
+            try:
+                response = self._session.get('{}/get?hash={}'.format(self._url, key), timeout=self._timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if last:
+                    raise
+            else:
+                if response.status_code < 500 or last:
+                    break
+            # exponential backoff with jitter so concurrent fetches don't retry all at once
+            gevent.sleep(self._backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+
+class TTLCache:
+    """
+    LRU cache of bounded size whose entries expire ttl seconds after they are loaded
+    """
+
+    def __init__(self, ttl, size):
+        self._ttl = ttl
+        self._size = size
+        self._entries = OrderedDict()  # key -> (load time, value)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, load):
+        """
+        get the value of key, load is called to get the value if it is not cached or expired
+        """
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[0] < self._ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = load()
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        drop key from the cache, or all the keys if key is None
+        """
+        if key is None:
+            self._entries.clear()
+        elif self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'size': len(self._entries),
+        }
+
+
+class StageStats:
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.latency = Histogram()
+
+    def observe(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.latency.observe(duration)
+
+    def to_dict(self):
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'count': self.count,
+            'avgLatency': self.total / self.count if self.count else 0.0,
+            'maxLatency': self.max,
+            'p50Latency': self.latency.quantile(0.5),
+            'p99Latency': self.latency.quantile(0.99),
+        }
+
+
+class Pipeline:
+    """
+    bounds the amount of transactions concurrently in each processing stage
+    and keeps the queue depth and latency of every stage
+    """
+
+    def __init__(self, limits):
+        self._semaphores = {name: BoundedSemaphore(limit or 1) for name, limit in limits.items()}
+        self._stats = {name: StageStats() for name in limits}
+
+    @contextmanager
+    def stage(self, name):
+        stats = self._stats[name]
+        stats.queued += 1
+        self._semaphores[name].acquire()
+        stats.queued -= 1
+        stats.running += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            stats.running -= 1
+            stats.observe(time.time() - start)
+            self._semaphores[name].release()
+
+    def metrics(self):
+        return {name: stats.to_dict() for name, stats in self._stats.items()}
+
+
+# keys the reservation index can be queried by, next to the expiry
+INDEX_KEYS = ('type', 'location', 'email', 'threebotId', 'state')
+
+
+def reservation_record(data, cleaned=False):
+    """
+    get the entry of the reservation index of a reservation from its data
+    """
+    return {
+        'type': data.get('type'),
+        'size': data.get('size'),
+        'location': data.get('location'),
+        'email': data.get('email'),
+        'threebotId': data.get('threebotId'),
+        'expiryTimestamp': data.get('expiryTimestamp') or 0,
+        'amount': (data.get('amount') or 0) + (data.get('extensionAmount') or 0),
+        'state': 'cleaned' if cleaned else 'active',
+    }
+
+
+class ReservationIndex:
+    """
+    in memory secondary index of the reservations by type, location, email, 3bot id, state and expiry
+
+    the index is built once from the data of the reservation services and then kept up to date
+    by the broker on install and extend and by the reservations on cleanup
+    """
+
+    def __init__(self):
+        self._records = {}  # reservation name -> record
+        self._keys = {key: defaultdict(set) for key in INDEX_KEYS}  # key -> value -> reservation names
+        self._expiry = []  # sorted (expiryTimestamp, reservation name)
+
+    def __len__(self):
+        return len(self._records)
+
+    def rebuild(self, reservations):
+        """
+        build the index from an iterable of (name, data, cleaned)
+        """
+        self._records = {name: reservation_record(data, cleaned) for name, data, cleaned in reservations}
+        self._keys = {key: defaultdict(set) for key in INDEX_KEYS}
+        for name, record in self._records.items():
+            for key in INDEX_KEYS:
+                self._keys[key][record[key]].add(name)
+        self._expiry = sorted((record['expiryTimestamp'], name) for name, record in self._records.items())
+
+    def update(self, name, record):
+        self.remove(name)
+        self._records[name] = record
+        for key in INDEX_KEYS:
+            self._keys[key][record[key]].add(name)
+        bisect.insort(self._expiry, (record['expiryTimestamp'], name))
+
+    def remove(self, name):
+        record = self._records.pop(name, None)
+        if record is None:
+            return
+        for key in INDEX_KEYS:
+            names = self._keys[key][record[key]]
+            names.discard(name)
+            if not names:
+                del self._keys[key][record[key]]
+        entry = (record['expiryTimestamp'], name)
+        i = bisect.bisect_left(self._expiry, entry)
+        if i < len(self._expiry) and self._expiry[i] == entry:
+            del self._expiry[i]
+
+    def query(self, filters=None, expires_after=None, expires_before=None, page=1, page_size=100):
+        """
+        get a page of the reservations matching all filters and expiring in [expires_after, expires_before),
+        ordered by expiry, with the total amount paid per reservation type of all the matches
+        """
+        if page < 1 or page_size < 1:
+            raise ValueError("page and page size must be positive")
+
+        candidates = None
+        sets = []
+        for key, value in (filters or {}).items():
+            if key not in INDEX_KEYS:
+                raise ValueError("reservations can't be queried by %s" % key)
+            sets.append(self._keys[key].get(value, set()))
+        if sets:
+            # intersect starting from the most selective key
+            sets.sort(key=len)
+            candidates = sets[0].intersection(*sets[1:])
+
+        low = 0 if expires_after is None else bisect.bisect_left(self._expiry, (expires_after,))
+        high = len(self._expiry) if expires_before is None else bisect.bisect_left(self._expiry, (expires_before,))
+
+        if candidates is None:
+            matches = [name for _, name in self._expiry[low:high]]
+        elif len(candidates) < high - low:
+            matches = []
+            for name in candidates:
+                expiry = self._records[name]['expiryTimestamp']
+                if (expires_after is None or expiry >= expires_after) and (expires_before is None or expiry < expires_before):
+                    matches.append((expiry, name))
+            matches = [name for _, name in sorted(matches)]
+        else:
+            matches = [name for _, name in self._expiry[low:high] if name in candidates]
+
+        amounts = defaultdict(int)
+        for name in matches:
+            record = self._records[name]
+            amounts[record['type']] += record['amount']
+
+        start = (page - 1) * page_size
+        reservations = []
+        for name in matches[start:start + page_size]:
+            reservation = dict(self._records[name])
+            reservation['name'] = name
+            reservations.append(reservation)
+
+        return {
+            'total': len(matches),
+            'page': page,
+            'pageSize': page_size,
+            'amounts': dict(amounts),
+            'reservations': reservations,
+        }
+
+
+class ProcessedTransactions:
+    """
+    set of processed transaction ids bucketed by block height
+
+    ids are kept as raw bytes and every bucket is serialized as a single base64 blob,
+    so the buckets below the watcher cursor can be dropped and saving the service
+    only re-encodes the buckets that changed.
+    Unconfirmed transactions (height 0) are never pruned, they are moved to their
+    block as soon as they are seen again with a height.
+    """
+
+    # bucket used for ids migrated from the legacy dict, their height is unknown
+    LEGACY_HEIGHT = 1
+
+    def __init__(self):
+        self._heights = {}  # id -> height
+        self._buckets = {}  # height -> set of ids
+        self._blobs = {}  # height -> serialized bucket, cleared when the bucket changes
+
+    @classmethod
+    def load(cls, data):
+        store = cls()
+        for height, blob in (data or {}).items():
+            height = int(height)
+            raw = base64.b64decode(blob)
+            bucket = {raw[i:i + TX_ID_SIZE] for i in range(0, len(raw), TX_ID_SIZE)}
+            store._buckets[height] = bucket
+            store._blobs[height] = blob
+            for tx_id in bucket:
+                store._heights[tx_id] = height
+        return store
+
+    @classmethod
+    def from_legacy(cls, processed):
+        """
+        create a store from the legacy {tx_id: True} dict
+        """
+        store = cls()
+        for tx_id, done in processed.items():
+            if done:
+                store.add(tx_id, cls.LEGACY_HEIGHT)
+        return store
+
+    def __contains__(self, tx_id):
+        return bytes.fromhex(tx_id) in self._heights
+
+    def __len__(self):
+        return len(self._heights)
+
+    def add(self, tx_id, height=0):
+        tx_id = bytes.fromhex(tx_id)
+        previous = self._heights.get(tx_id)
+        if previous is not None:
+            # an id seen again while still unconfirmed keeps its bucket
+            if previous == height or (not height and previous != self.LEGACY_HEIGHT):
+                return
+            self._discard(tx_id, previous)
+
+        self._heights[tx_id] = height
+        self._buckets.setdefault(height, set()).add(tx_id)
+        self._blobs.pop(height, None)
+
+    def _discard(self, tx_id, height):
+        bucket = self._buckets[height]
+        bucket.discard(tx_id)
+        if not bucket:
+            del self._buckets[height]
+        self._blobs.pop(height, None)
+
+    def prune(self, height):
+        """
+        drop all the confirmed transactions below height
+        """
+        for bucket_height in [h for h in self._buckets if 0 < h < height]:
+            for tx_id in self._buckets.pop(bucket_height):
+                del self._heights[tx_id]
+            self._blobs.pop(bucket_height, None)
+
+    def dump(self):
+        data = {}
+        for height, bucket in self._buckets.items():
+            blob = self._blobs.get(height)
+            if blob is None:
+                blob = base64.b64encode(b''.join(bucket)).decode()
+                self._blobs[height] = blob
+            data[str(height)] = blob
+        return data
+
+
+class RefundQueue:
+    """
+    persistent queue of the refunds of transactions
+
+    the pending refunds to the same address are paid out as a single transaction,
+    the id of the payout transaction is kept for every refunded transaction
+    """
+
+    def __init__(self):
+        self._refunds = OrderedDict()  # refunded tx id -> refund
+
+    @classmethod
+    def load(cls, data):
+        queue = cls()
+        for refund in data or []:
+            queue._refunds[refund['txId']] = dict(refund)
+        return queue
+
+    def __contains__(self, tx_id):
+        return tx_id in self._refunds
+
+    def __len__(self):
+        return len(self._refunds)
+
+    def add(self, tx_id, address, amount):
+        if tx_id in self._refunds:
+            return
+        self._refunds[tx_id] = {'txId': tx_id, 'address': address, 'amount': amount, 'payoutTxId': '', 'paidAt': 0}
+
+    def get(self, tx_id):
+        return self._refunds.get(tx_id)
+
+    def pending(self):
+        return sum(1 for refund in self._refunds.values() if not refund['payoutTxId'])
+
+    def payouts(self):
+        """
+        list the pending refunds grouped by address as (address, amount, refunded tx ids),
+        a group pays a single minerfee
+        """
+        groups = OrderedDict()
+        for refund in self._refunds.values():
+            if not refund['payoutTxId']:
+                groups.setdefault(refund['address'], []).append(refund)
+        return [
+            (address, sum(refund['amount'] for refund in refunds) - DEFAULT_MINERFEE, [refund['txId'] for refund in refunds])
+            for address, refunds in groups.items()
+        ]
+
+    def paid(self, tx_ids, payout_id):
+        now = int(time.time())
+        for tx_id in tx_ids:
+            self._refunds[tx_id].update(payoutTxId=payout_id, paidAt=now)
+
+    def prune(self, before):
+        """
+        drop the refunds paid before the given timestamp, return the amount of dropped refunds
+        """
+        paid = [tx_id for tx_id, refund in self._refunds.items() if refund['payoutTxId'] and refund['paidAt'] < before]
+        for tx_id in paid:
+            del self._refunds[tx_id]
+        return len(paid)
+
+    def dump(self):
+        return [dict(refund) for refund in self._refunds.values()]
+
+
+class EmailTemplate:
+    """
+    html email with {placeholder} fields, compiled once into a printf style format
+    """
+
+    def __init__(self, path, fields):
+        with open(path) as f:
+            source = f.read()
+
+        parts = []
+        self.fields = []
+        for literal, field, spec, conversion in Formatter().parse(source):
+            parts.append(literal.replace('%', '%%'))
+            if field is None:
+                continue
+            if spec or conversion or not field.isidentifier():
+                raise ValueError("unsupported placeholder {%s} in email template %s" % (field, path))
+            if field not in fields:
+                raise ValueError("unknown placeholder {%s} in email template %s" % (field, path))
+            parts.append('%s')
+            self.fields.append(field)
+        self._format = ''.join(parts)
+
+    def render(self, data):
+        return self._format % tuple(data[field] for field in self.fields)
+
+
+class EmailTemplates:
+    """
+    registry of the email templates, loaded from the template directory at import
+    so a broken template fails the robot start instead of a send
+    """
+
+    def __init__(self, directory, specs):
+        self._templates = {
+            name: EmailTemplate(os.path.join(directory, filename), fields)
+            for name, (filename, fields) in specs.items()
+        }
+
+    def render(self, name, data):
+        return self._templates[name].render(data)
+
+
+# name -> (file, fields the template can use)
+EMAIL_TEMPLATES = {
+    'vm': ('_vm_template.html', {'expiry', 'zos_addr', 'robot_url', 'vnc_addr'}),
+    's3': ('_s3_template.html', {'expiry', 'urls', 'domain', 'login', 'password'}),
+    'namespace': ('_namespace_template.html', {'expiry', 'ip', 'port', 'password', 'nsName'}),
+    'reverse_proxy': ('_proxy_template.html', {'expiry', 'domain', 'ip', 'backends'}),
+    'refund': ('_refund_template.html', {'action', 'refund_status', 'address', 'type', 'tx_id', 'error'}),
+    'extend': ('_extend_template.html', {'tx_id', 'type', 'expiry'}),
+}
+
+# reservation type -> subject of the email sent with the connection info
+CONNECTION_INFO_SUBJECTS = {
+    'vm': "Your virtual 0-OS is ready on the Threefold grid",
+    's3': "Your S3 archive server is ready on the Threefold grid",
+    'namespace': "Your 0-DB namespace is ready on the Threefold grid",
+    'reverse_proxy': 'Your reverse proxy is ready on the Threefold grid',
+}
+
+_email_templates = EmailTemplates(os.path.dirname(os.path.abspath(__file__)), EMAIL_TEMPLATES)
+
 DEFAULT_MINERFEE = 100000000
 TFT_PRECISION = 1000000000
-
-_vm_template = """
-<html>
-
-<body>
-    <h1>Your virtual 0-OS has been deployed and expires on {expiry}</h1>
-    <div class="content">
-        <p>Make sure you have joined the <a href="https://github.com/threefoldtech/home/blob/master/docs/threefold_grid/networks.md#public-threefold-network-9bee8941b5717835">public
-                threefold zerotier network</a> : <em>9bee8941b5717835</em></p>
-        <p>
-            <ul>
-                <li>0-OS address: {zos_addr}</li>
-                <li>0-robot url: <a href="{robot_url}">{robot_url}</a></li>
-                <li>VNC address: <pre>{vnc_addr}<pre></li>
-            </ul>
-        </p>
-    </div>
-</body>
-
-</html>
-"""
-
-_s3_template = """
-<html>
-<body>
-    <h1>Your S3 archive server has been deployed and expires on {expiry}</h1>
-    <div class="content">
-        <p>Make sure you have joined the <a href="https://github.com/threefoldtech/home/blob/master/docs/threefold_grid/networks.md#public-threefold-network-9bee8941b5717835">public
-                threefold zerotier network</a> : <em>9bee8941b5717835</em></p>
-        <p>
-            <ul>
-                <li>S3 url: {urls}</li>
-                <li>S3 domain: {domain}</li>
-                <li>Login: {login}</li>
-                <li>Password: {password}</li>
-            </ul>
-        </p>
-    </div>
-</body>
-</html>
-"""
-
-_namespace_template = """
-<html>
-<body>
-    <h1>Your 0-DB namespace has been deployed and expires on {expiry}</h1>
-    <div class="content">
-        <p>Make sure you have joined the <a
-                href="https://github.com/threefoldtech/home/blob/master/docs/threefold_grid/networks.md#public-threefold-network-9bee8941b5717835"
-                target="blank">public
-                threefold zerotier network</a> : <em>9bee8941b5717835</em></p>
-        <p>
-            <ul>
-                <li>0-DB host: {ip}</li>
-                <li>0-DB port: {port}</li>
-                <li>Password: {password}</li>
-                <li>Namespace name: {nsName}</li>
-            </ul>
-        </p>
-        <p>For mode detail about 0-DB itself, head to the documentation on Github:
-            <a href="https://github.com/threefoldtech/0-db/blob/development/README.md"
-                target="blank">https://github.com/threefoldtech/0-db/blob/development/README.md</a>
-        </p>
-    </div>
-</body>
-</html>
-"""
-
-_proxy_template = """
-<html>
-<body>
-    <h1>Your reverse_proxy has been deployed and expires on {expiry}</h1>
-    <div class="content">
-        <p>Make sure that you have pointed your DNS configuration for the domain {domain} to the IP address: <em>{ip}</em></p>
-    </div>
-</body>
-</html>
-"""
-
-_refund_template = """
-<html>
-
-<body>
-    <h1>We could not {action} your reservation at this time</h1>
-    <div class="content">
-        <p>Unfortunately, we could not {action} your reservation. Your reservation {refund_status} to {address}. Please try again at a later time</p>
-    </div>
-    <div class="error">
-        <h3>Error detail:</h3>
-        <ul>
-            <li>
-                <p>transaction ID of the {type}: <em>{tx_id}</em></p>
-            </li>
-            <li>error: <code>{error}</code></li>
-        </ul>
-    </div>
-</body>
-</html>
-"""
-
-_extend_template = """
-<html>
-<body>
-    <h1>Your reservation has been extended successfully</h1>
-    <div class="content">
-        <p>
-            <ul>
-                <li>Reservation ID: {tx_id}</li>
-                <li>Reservation type: {type}</li>
-                <li>Expiry date: {expiry}</li>
-            </ul>
-        </p>
-    </div>
-</body>
-</html>
-"""
@@ -0,0 +1,244 @@
+"""
+benchmarks of the grid broker hot paths
+
+run with: python grid_broker_bench.py
+"""
+# the robot runs monkey patched by gevent
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import time
+
+import requests
+
+from nacl.public import Box
+from nacl.signing import SigningKey
+
+from grid_broker import ProcessedTransactions, NotaryClient, TTLCache, TransactionWatcher, decryption_box
+from grid_broker import CONNECTION_INFO_SUBJECTS, _email_templates, ReservationIndex, reservation_record
+from grid_broker_test import NotaryStub, TransactionMock, ChainWalletMock
+
+
+def _timeit(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_processed_transactions(sizes=(10000, 100000, 1000000), per_block=5):
+    """
+    compare save and lookup cost of the legacy processed dict
+    with the height bucketed ProcessedTransactions store
+    """
+    print("processed transactions: save (s) / lookup (us) / serialized size (bytes)")
+    for size in sizes:
+        ids = ['%064x' % i for i in range(size)]
+        legacy = {tx_id: True for tx_id in ids}
+        store = ProcessedTransactions()
+        for i, tx_id in enumerate(ids):
+            store.add(tx_id, 1 + i // per_block)
+        lookups = ids[::max(1, size // 10000)]
+
+        legacy_save = _timeit(lambda: json.dumps(legacy))
+        legacy_lookup = _timeit(lambda: [legacy.get(tx_id, False) for tx_id in lookups]) / len(lookups)
+
+        store.dump()
+        # a watch cycle only touches the most recent block
+        store.add('%064x' % size, size // per_block)
+        store_save = _timeit(lambda: json.dumps(store.dump()))
+        store_lookup = _timeit(lambda: [tx_id in store for tx_id in lookups]) / len(lookups)
+
+        # after pruning only the reorg window is kept
+        pruned = ProcessedTransactions.load(store.dump())
+        pruned.prune(size // per_block - 10)
+        pruned_save = _timeit(lambda: json.dumps(pruned.dump()))
+
+        print("%8d legacy: %.4f / %.3f / %d" % (
+            size, legacy_save, legacy_lookup * 1e6, len(json.dumps(legacy))))
+        print("%8d store:  %.4f / %.3f / %d" % (
+            size, store_save, store_lookup * 1e6, len(json.dumps(store.dump()))))
+        print("%8d pruned: %.4f / - / %d" % (
+            size, pruned_save, len(json.dumps(pruned.dump()))))
+
+
+def bench_notary(sizes=(1, 10, 100), latency=0.02):
+    """
+    compare fetching the notary data of every transaction of a watch cycle
+    one by one with a new connection against a prefetch with the pooled client
+    """
+    print("notary fetch per watch cycle, %dms latency: sequential (s) / prefetch (s)" % (latency * 1000))
+    keys = ['%064x' % i for i in range(max(sizes))]
+    with NotaryStub({key: {'threebot_id': 1} for key in keys}, latency=latency) as notary:
+        for size in sizes:
+            cycle = keys[:size]
+
+            def sequential():
+                for key in cycle:
+                    requests.get('{}/get?hash={}'.format(notary.url, key), timeout=30).json()
+
+            def prefetch():
+                client = NotaryClient(notary.url)
+                client.prefetch(cycle)
+                for key in cycle:
+                    client.get(key)
+
+            print("%4d: %.3f / %.3f" % (size, _timeit(sequential, 1), _timeit(prefetch, 1)))
+
+
+def bench_decryption(count=10000, bots=10):
+    """
+    compare decrypting reservation payloads sent by a few 3bots to the broker address
+    with and without caching the key material
+    """
+    broker_key = SigningKey.generate()
+    bot_keys = [SigningKey.generate() for _ in range(bots)]
+    payloads = []
+    for i in range(count):
+        bot_key = bot_keys[i % bots]
+        box = Box(bot_key.to_curve25519_private_key(), broker_key.verify_key.to_curve25519_public_key())
+        payloads.append((i % bots, bot_key.verify_key, box.encrypt(b'reservation data %d' % i)))
+
+    def uncached():
+        for _, verify_key, content in payloads:
+            decryption_box(verify_key, broker_key).decrypt(content)
+
+    def cached():
+        cache = TTLCache(3600, 1000)
+        for bot, verify_key, content in payloads:
+            cache.get(('address', bot), lambda: decryption_box(verify_key, broker_key)).decrypt(content)
+
+    print("decrypt %d payloads from %d 3bots: uncached (s) / cached (s)" % (count, bots))
+    print("%.3f / %.3f" % (_timeit(uncached, 1), _timeit(cached, 1)))
+
+
+def bench_watcher_filter(addresses=10000, count=100000):
+    """
+    compare the filtering of the transactions of a watch against a list of wallet addresses
+    with the frozenset snapshot of the watcher
+    """
+    wallet = ChainWalletMock([])
+    wallet.addresses = ['address%d' % i for i in range(addresses)]
+    txns = []
+    for i in range(count):
+        # one in ten transactions is change returned to one of our addresses
+        sender = wallet.addresses[i % addresses] if i % 10 == 0 else 'sender%d' % i
+        txns.append(TransactionMock(10, height=1 + i // 10, from_addresses=[sender, 'other%d' % i]))
+
+    def legacy():
+        selected = []
+        for tx in txns:
+            if tx._locked:
+                continue
+            to_self = False
+            for address in tx.from_addresses:
+                if address in wallet.addresses:
+                    to_self = True
+                    break
+            if not to_self:
+                selected.append(tx)
+
+    def snapshot():
+        TransactionWatcher(wallet).filter(txns)
+
+    print("filter %d transactions with %d wallet addresses: list (s) / snapshot (s)" % (count, addresses))
+    # scanning the address list is too slow to run on all transactions, time 1% and extrapolate
+    sample = txns
+    txns = sample[:count // 100]
+    legacy_time = _timeit(legacy, 1) * 100
+    txns = sample
+    print("%.3f / %.3f" % (legacy_time, _timeit(snapshot)))
+
+
+def bench_email_templates(count=100000):
+    """
+    compare rendering the connection info emails with str.format on the template source
+    and an if/elif dispatch, with the compiled template registry
+    """
+    infos = [
+        {'type': 'vm', 'expiry': '01/01/20', 'zos_addr': '10.0.0.1:6379',
+         'robot_url': 'http://10.0.0.1:6600', 'vnc_addr': '1.1.1.1:5900'},
+        {'type': 's3', 'expiry': '01/01/20', 'urls': 'http://10.0.0.2:9000',
+         'domain': 'abcdef.wg01.grid.tf', 'login': 'login', 'password': 'password'},
+        {'type': 'namespace', 'expiry': '01/01/20', 'ip': '10.0.0.3', 'port': 9900,
+         'password': 'password', 'nsName': 'namespace'},
+    ]
+    sources = {}
+    for name in ('vm', 's3', 'namespace'):
+        with open('_%s_template.html' % name) as f:
+            sources[name] = f.read()
+    notifications = [infos[i % len(infos)] for i in range(count)]
+
+    def legacy():
+        for data in notifications:
+            if data['type'] == 'vm':
+                sources['vm'].format(**data)
+            elif data['type'] == 's3':
+                sources['s3'].format(**data)
+            elif data['type'] == 'namespace':
+                sources['namespace'].format(**data)
+
+    def registry():
+        for data in notifications:
+            CONNECTION_INFO_SUBJECTS[data['type']]
+            _email_templates.render(data['type'], data)
+
+    print("render %d notifications: str.format (s) / registry (s)" % count)
+    print("%.3f / %.3f" % (_timeit(legacy), _timeit(registry)))
+
+
+def bench_reservation_index(count=50000, queries=100):
+    """
+    compare answering reservation queries by scanning the data of all the reservation services
+    with the reservation index, and time the rebuild of the index on startup
+    """
+    types = ('vm', 's3', 'namespace')
+    now = int(time.time())
+    reservations = [
+        ('%064x' % i, {
+            'type': types[i % 3], 'size': 1 + i % 2, 'location': 'farm%d' % (i % 20),
+            'email': 'user%d@mail' % (i % 5000), 'threebotId': str(i % 2000),
+            'expiryTimestamp': now + (i * 7919) % (365 * 86400), 'amount': 10 ** 9,
+        }, i % 4 == 0)
+        for i in range(count)
+    ]
+    emails = ['user%d@mail' % i for i in range(queries)]
+    index = ReservationIndex()
+
+    def scan():
+        for email in emails:
+            matches = [(data['expiryTimestamp'], name) for name, data, _ in reservations
+                       if data['email'] == email and data['type'] == 'vm']
+            sorted(matches)[:100]
+
+    def indexed():
+        for email in emails:
+            index.query({'email': email, 'type': 'vm'})
+
+    def expiring():
+        index.query(expires_before=now + 7 * 86400)
+
+    def update():
+        for name, data, _ in reservations[:queries]:
+            index.update(name, reservation_record(data))
+
+    print("%d reservations: rebuild (s)" % count)
+    print("%.3f" % _timeit(lambda: index.rebuild(reservations)))
+    print("%d queries by email and type: scan (s) / index (s)" % queries)
+    print("%.3f / %.3f" % (_timeit(scan), _timeit(indexed)))
+    print("expiring within a week (ms) / %d updates (ms)" % queries)
+    print("%.3f / %.3f" % (_timeit(expiring) * 1000, _timeit(update) * 1000))
+
+
+if __name__ == '__main__':
+    bench_processed_transactions()
+    bench_notary()
+    bench_decryption()
+    bench_watcher_filter()
+    bench_email_templates()
+    bench_reservation_index()
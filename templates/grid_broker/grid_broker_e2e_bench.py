@@ -0,0 +1,440 @@
+"""
+end to end benchmark of the grid broker, from the incoming transactions of the wallet
+to the connection info emails, the extensions and the cleanup of the reservations.
+
+The wallet, notary, 3bot records, robots and sendgrid are replaced by local stand-ins
+with configurable latency and failure rate, the broker and reservation templates run as is.
+
+run with: python grid_broker_e2e_bench.py
+"""
+# the robot runs monkey patched by gevent
+from gevent import monkey
+monkey.patch_all()
+
+import base64
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+import uuid
+from collections import namedtuple
+from unittest import mock
+
+import gevent
+from gevent.pool import Group
+from jumpscale import j
+from nacl.public import Box
+from nacl.signing import SigningKey
+from zerorobot.service_collection import ServiceNotFoundError
+from zerorobot.template.base import TemplateBase
+from zerorobot.template.state import StateCheckError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reservation'))
+
+import reservation
+from grid_broker import GridBroker, NotaryClient, ProcessedTransactions, RESERVATION_UID, DEFAULT_MINERFEE
+from reservation import Reservation, CATALOG
+from grid_broker_test import NotaryStub, TransactionMock
+
+BROKER_UID = 'github.com/threefoldtech/grid_broker/grid_broker/0.0.1'
+Record = namedtuple('Record', ['expiration_timestamp'])
+
+
+class FakeWallet:
+    """
+    tfchain wallet with history transactions already processed by the broker,
+    the benchmarked transactions are added a block at a time with mine
+    """
+
+    def __init__(self, history=0, per_block=50):
+        self.addresses = ['broker']
+        self.key = SigningKey.generate()
+        self.height = 1
+        self.sent = []
+        self._transactions = []
+        for i in range(history):
+            self._transactions.append(TransactionMock(DEFAULT_MINERFEE, height=1 + i // per_block))
+            self.height = 1 + i // per_block
+        self._bots = {}
+
+    def list_incoming_transactions(self, min_height=0):
+        # newest first like the tfchain wallet
+        return [tx for tx in reversed(self._transactions) if tx.height >= min_height]
+
+    def mine(self, txns):
+        self.height += 1
+        for tx in txns:
+            tx.height = self.height
+        self._transactions.extend(txns)
+
+    def private_key(self, address):
+        return bytes(self.key) + bytes(self.key.verify_key)
+
+    def add_3bot(self, id, key):
+        self._bots[id] = key
+
+    def get_3bot_key(self, id):
+        return 'ed25519:' + bytes(self._bots[id].verify_key).hex()
+
+    def send_money(self, amount, recipient):
+        self.sent.append((amount, recipient))
+        return '%064x' % len(self.sent)
+
+
+class FakeTfchainClient:
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.config = mock.Mock(data={'network': 'testnet'})
+
+
+class ThreebotRecords:
+    """
+    3bot record source whose lookups take latency seconds
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lookups = 0
+
+    def get_record(self, id, network=None):
+        self.lookups += 1
+        gevent.sleep(self.latency)
+        return Record(int(time.time()) + 365 * 86400)
+
+
+class FakeState:
+
+    def __init__(self):
+        self._states = {}
+
+    def set(self, category, tag, state):
+        self._states[(category, tag)] = state
+
+    def check(self, category, tag, state):
+        if self._states.get((category, tag)) != state:
+            raise StateCheckError("%s %s is not %s" % (category, tag, state))
+
+
+class FakeTask:
+    """
+    task of an action that already ran in the calling greenlet
+    """
+
+    def __init__(self, action, args):
+        self.result = None
+        self.eco = None
+        try:
+            self.result = action(**args)
+            self.state = 'ok'
+        except Exception as err:
+            self.eco = mock.Mock(trace=str(err))
+            self.state = 'error'
+            self._error = err
+
+    def wait(self, die=False):
+        if die and self.state != 'ok':
+            raise self._error
+        return self
+
+
+class LocalService:
+    """
+    wraps a template instance so its scheduled actions run directly
+    """
+
+    def __init__(self, uid, service):
+        self.uid = uid
+        self.service = service
+
+    def __getattr__(self, name):
+        return getattr(self.service, name)
+
+    def schedule_action(self, action, args=None):
+        return FakeTask(getattr(self.service, action), args or {})
+
+    def delete(self):
+        self.service.api.services.remove(self)
+
+
+class FakeService:
+    """
+    service of a robot whose actions take latency seconds,
+    installs fail with a capacity error at the given rate
+    """
+
+    RESULTS = {
+        'info': {'zerotier': {'ip': '10.0.0.1'}, 'host': {'public_addr': '1.1.1.1'}, 'vnc': 5900},
+        'connection_info': {'ip': '10.0.0.2', 'port': 9900},
+    }
+
+    def __init__(self, services, uid, name, data, latency, failure_rate):
+        self.uid = uid
+        self.template_uid = mock.Mock()
+        self.template_uid.name = uid.split('/')[-2]
+        self.name = name
+        self.guid = str(uuid.uuid4())
+        self.data = data
+        self._services = services
+        self._latency = latency
+        self._failure_rate = failure_rate
+
+    def schedule_action(self, action, args=None):
+        return FakeTask(self._run, {'action': action})
+
+    def _run(self, action):
+        gevent.sleep(self._latency)
+        if action == 'install' and random.random() < self._failure_rate:
+            raise RuntimeError("not enough storage space on the node")
+        return self.RESULTS.get(action)
+
+    def delete(self):
+        self._services.remove(self)
+
+
+class FakeServices:
+
+    def __init__(self, create):
+        self._create = create
+        self.guids = {}
+
+    def add(self, service):
+        self.guids[service.guid] = service
+        return service
+
+    def remove(self, service):
+        self.guids.pop(service.guid, None)
+
+    def find(self, template_uid=None, template_name=None, name=None):
+        return [
+            s for s in list(self.guids.values())
+            if (template_uid is None or s.uid == template_uid)
+            and (template_name is None or s.uid.split('/')[-2] == template_name)
+            and (name is None or s.name == name)
+        ]
+
+    def get(self, template_uid=None, name=None):
+        services = self.find(template_uid=template_uid, name=name)
+        if not services:
+            raise ServiceNotFoundError("service %s not found" % name)
+        return services[0]
+
+    def find_or_create(self, template_uid, service_name, data):
+        services = self.find(template_uid=template_uid, name=service_name)
+        if services:
+            return services[0]
+        return self.add(self._create(template_uid, service_name, data))
+
+
+class FakeRobots:
+    """
+    robots of the nodes of a farm, their services take latency seconds to run an action
+    """
+
+    def __init__(self, nodes, latency, failure_rate):
+        self._apis = {}
+        for i in range(nodes):
+            api = FakeRobotAPI(latency, failure_rate)
+            self._apis['node%d' % i] = api
+
+    def get(self, node_id, address=None):
+        return self._apis[node_id]
+
+    def least_used_node(self, farmname, reserve=None):
+        return random.choice(list(self._apis))
+
+    def capacity_planning(self, location, disk_type, size=0):
+        node_id = random.choice(list(self._apis))
+        return {'node_id': node_id, 'robot_address': 'http://%s:6600' % node_id}
+
+
+class FakeRobotAPI:
+
+    def __init__(self, latency, failure_rate, robots=None):
+        self._latency = latency
+        self._failure_rate = failure_rate
+        self.services = FakeServices(self._create)
+        self.robots = robots
+
+    def _create(self, uid, name, data):
+        if uid == RESERVATION_UID:
+            return LocalService(uid, create_service(Reservation, self, name, dict(RESERVATION_DEFAULTS, **data)))
+        return FakeService(self.services, uid, name, data, self._latency, self._failure_rate)
+
+
+class FakeMailer:
+    """
+    sendgrid client service recording when every receiver got an email
+    """
+
+    uid = 'github.com/threefoldtech/0-templates/sendgrid_client/0.0.1'
+    name = 'sendgrid'
+
+    def __init__(self):
+        self.guid = str(uuid.uuid4())
+        self.sent = {}
+
+    def schedule_action(self, action, args=None):
+        return FakeTask(self.send, args)
+
+    def send(self, sender, receiver, subject, content):
+        self.sent[receiver] = (time.time(), subject)
+
+
+# defaults of the reservation schema
+RESERVATION_DEFAULTS = {'organization': '', 'password': '', 'createdServices': [], 'backendUrls': []}
+
+
+def create_service(template, api, name, data):
+    """
+    create a template instance outside of a robot
+    """
+    def init(self, name=None, guid=None, data=None):
+        self.name = name
+        self.guid = guid or str(uuid.uuid4())
+        self.data = data or {}
+
+    with mock.patch.object(TemplateBase, '__init__', init), \
+            mock.patch.object(TemplateBase, 'recurring_action', lambda *args, **kwargs: None):
+        service = template(name=name, data=data)
+    service.api = api
+    service.state = FakeState()
+    service.logger = logging.getLogger(name)
+    # keep the serialization cost of saving the service
+    service.save = lambda: json.dumps(service.data, default=str)
+    return service
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _rss():
+    # maximum resident set size in KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_end_to_end(transactions=1000, per_block=50, history=100000, bots=20, nodes=10, extensions=0.2,
+                     notary_latency=0.01, record_latency=0.01, robot_latency=0.02, failure_rate=0.01):
+    """
+    run transactions through the broker, a block of per_block transactions per watch,
+    followed by the cleanup of all the reservations.
+    extensions is the share of the transactions that extend a previous reservation
+    """
+    wallet = FakeWallet(history, per_block)
+    records = ThreebotRecords(record_latency)
+    robots = FakeRobots(nodes, robot_latency, failure_rate)
+    api = FakeRobotAPI(robot_latency, failure_rate, robots)
+    mailer = api.services.add(FakeMailer())
+
+    bot_keys = {}
+    for i in range(bots):
+        bot_keys[i] = SigningKey.generate()
+        wallet.add_3bot(i, bot_keys[i])
+    broker_key = wallet.key.verify_key.to_curve25519_public_key()
+
+    def payload(bot, data):
+        box = Box(bot_keys[bot].to_curve25519_private_key(), broker_key)
+        content = box.encrypt(j.data.serializer.msgpack.dumps(data))
+        return {
+            'content': base64.b64encode(content).decode(),
+            'content_signature': base64.b64encode(bot_keys[bot].sign(content).signature).decode(),
+            'threebot_id': bot,
+        }
+
+    def reservation_tx(i, installed):
+        email = 'user%d@bench.grid.tf' % i
+        if installed and random.random() < extensions:
+            tx_id, typ, size = random.choice(installed)
+            data = {'type': 'extension', 'transaction_id': tx_id, 'duration': 1, 'email': email}
+        elif i % 2:
+            typ, size = 'vm', 1
+            data = {'type': typ, 'size': size, 'location': 'benchfarm', 'duration': 1, 'email': email}
+        else:
+            typ, size = 'namespace', 10
+            data = {'type': typ, 'size': size, 'location': 'benchfarm', 'duration': 1, 'email': email,
+                    'disk_type': 1, 'mode': 1, 'password': ''}
+        key = '%064x' % random.getrandbits(256)
+        notary.data[key] = payload(i % bots, data)
+        tx = TransactionMock(CATALOG.price(typ, size) + DEFAULT_MINERFEE, data=key.encode())
+        return tx, email, data['type'] != 'extension' and (tx.id, typ, size)
+
+    with NotaryStub(latency=notary_latency) as notary, \
+            mock.patch.object(j.clients.tfchain, 'get', return_value=FakeTfchainClient(wallet)), \
+            mock.patch.object(j.clients.tfchain.threebot, 'get_record', side_effect=records.get_record), \
+            mock.patch('JumpscaleLib.clients.blockchain.tfchain.TfchainNetwork.TfchainNetwork'), \
+            mock.patch.object(reservation, 'get_least_used_node_from_farm_s3', side_effect=robots.least_used_node), \
+            mock.patch.object(reservation, 'capacity_planning_namespace', side_effect=robots.capacity_planning):
+
+        processed = ProcessedTransactions()
+        for tx in wallet.list_incoming_transactions():
+            processed.add(tx.id, tx.height)
+        broker = create_service(GridBroker, api, 'broker', {
+            'wallet': 'bench', 'webGateway': 'web_gateway', 'minHeight': 0, 'lastHeight': wallet.height,
+            'processedTransactions': processed.dump(),
+            'parseConcurrency': 10, 'deployConcurrency': 5, 'notifyConcurrency': 10,
+            'threebotCacheTTL': 3600, 'threebotCacheSize': 1000,
+        })
+        broker._notary = NotaryClient(notary.url, concurrency=broker.data['parseConcurrency'])
+        api.services.add(LocalService(BROKER_UID, broker))
+
+        mined = {}  # receiver -> time the transaction was mined
+        installed = []
+        rss = None
+        elapsed = 0.0
+        for block in range(0, transactions, per_block):
+            txns = []
+            new = []
+            for i in range(block, min(transactions, block + per_block)):
+                # only the reservations of the previous blocks are extended
+                tx, email, reservation_id = reservation_tx(i, installed)
+                txns.append(tx)
+                mined[email] = time.time()
+                if reservation_id:
+                    new.append(reservation_id)
+            wallet.mine(txns)
+            installed.extend(new)
+
+            start = time.time()
+            broker._watch_transactions()
+            elapsed += time.time() - start
+            if rss is None:
+                # memory after warming up the caches and connections
+                gc.collect()
+                rss = _rss()
+
+        gc.collect()
+        growth = _rss() - rss
+        latencies = [sent - mined[receiver] for receiver, (sent, _) in mailer.sent.items() if receiver in mined]
+
+        # expire all the reservations and clean them up
+        reservations = api.services.find(template_uid=RESERVATION_UID)
+        for s in reservations:
+            s.data['expiryTimestamp'] = int(time.time()) - 1
+        start = time.time()
+        group = Group()
+        for s in reservations:
+            group.spawn(s._cleanup)
+        group.join()
+        cleanup = time.time() - start
+
+    print("%d transactions (%d 3bots, %d nodes, %.0f%% extensions, %.0f%% install failures)" % (
+        transactions, bots, nodes, extensions * 100, failure_rate * 100))
+    print("throughput (tx/s) / time to email p50 (s) / p99 (s) / emails / refunds")
+    print("%.1f / %.3f / %.3f / %d / %d" % (
+        transactions / elapsed, _percentile(latencies, 50), _percentile(latencies, 99),
+        len(latencies), len(wallet.sent)))
+    print("memory growth (KB) / 3bot record lookups / cleanup of %d reservations (s)" % len(reservations))
+    print("%d / %d / %.3f" % (growth, records.lookups, cleanup))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    bench_end_to_end()
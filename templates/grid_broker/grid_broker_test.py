@@ -1,26 +1,159 @@
+import json
+import logging
 import random
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-from grid_broker import TransactionWatcher
+import gevent
+import pytest
+from zerorobot.template.base import TemplateBase
+
+from grid_broker import GridBroker, TransactionWatcher, ProcessedTransactions, Pipeline, NotaryClient, TTLCache, EmailTemplate
+from grid_broker import ValidationError, _validate_reservation, ReservationIndex, reservation_record
+from grid_broker import WatchScheduler, RefundQueue, DEFAULT_MINERFEE, TFT_PRECISION, WATCH_TICK
+from grid_common.metrics import Histogram, Metrics, prometheus_text, _collectors
 
 
 class TransactionMock:
 
-    def __init__(self, amount, data=b''):
+    def __init__(self, amount, data=b'', height=0, from_addresses=None, locked=False, to_address='broker'):
+        self.id = '%064x' % random.getrandbits(256)
         self.amount = amount
         self.data = data
+        self.height = height
+        self.from_addresses = from_addresses or ['sender']
+        self.to_address = to_address
+        self._locked = locked
 
 
 class WalletMock:
+    """
+    wallet mock that mines a new block of up to 9 random transactions
+    every time the transactions are listed
+    """
 
     def __init__(self):
         self._transactions = []
+        self.addresses = ['broker']
+        self.height = 0
 
-    def list_incoming_transactions(self):
+    def list_incoming_transactions(self, min_height=0):
+        self.height += 1
         for i in range(int(random.random() * 10)):
-            tx = TransactionMock(random.random() * 100)
+            tx = TransactionMock(random.random() * 100, height=self.height)
             self._transactions.append(tx)
-        return self._transactions
+        # newest first like the tfchain wallet
+        return [tx for tx in reversed(self._transactions) if tx.height >= min_height]
+
+
+class ChainWalletMock:
+    """
+    wallet mock that returns the transactions from the requested height,
+    newest first like the tfchain wallet
+    """
+
+    def __init__(self, transactions):
+        self._transactions = transactions
+        self.addresses = ['broker']
+        self.requested_heights = []
+        self.sent = []
+
+    def list_incoming_transactions(self, min_height=0):
+        self.requested_heights.append(min_height)
+        txns = [tx for tx in self._transactions if tx.height >= min_height]
+        return list(reversed(txns))
+
+    def send_money(self, amount, recipient):
+        self.sent.append((amount, recipient))
+        return 'payout%d' % len(self.sent)
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class NotaryStub:
+    """
+    local http server that behaves like the notary /get endpoint
+
+    data: dict of the known keys and their data
+    latency: time in seconds every request takes
+    failures: amount of requests that fail with a 503 before the stub answers
+    """
+
+    def __init__(self, data=None, latency=0, failures=0):
+        self.data = data or {}
+        self.latency = latency
+        self.failures = failures
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                key = parse_qs(urlparse(self.path).query).get('hash', [''])[0]
+                if stub.failures:
+                    stub.failures -= 1
+                    self._reply(503, b'')
+                elif key in stub.data:
+                    self._reply(200, json.dumps(stub.data[key]).encode())
+                else:
+                    self._reply(404, b'')
+
+            def _reply(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _StubServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# defaults of the broker schema
+BROKER_DEFAULTS = {
+    'wallet': 'broker', 'webGateway': 'gateway', 'minHeight': 0, 'lastHeight': 0,
+    'parseConcurrency': 4, 'deployConcurrency': 4, 'notifyConcurrency': 4,
+    'threebotCacheTTL': 3600, 'threebotCacheSize': 100, 'refunds': [],
+}
+
+
+def create_broker(wallet, **data):
+    """
+    create a broker outside of a robot, listing the transactions of the given wallet
+    """
+    def init(self, name=None, guid=None, data=None):
+        self.name = name
+        self.guid = guid or name
+        self.data = data
+
+    with mock.patch.object(TemplateBase, '__init__', init), \
+            mock.patch.object(TemplateBase, 'recurring_action', lambda *args, **kwargs: None):
+        broker = GridBroker(name='broker', data=dict(BROKER_DEFAULTS, **data))
+    broker._wallet_ = wallet
+    broker._notary = mock.MagicMock()
+    broker.api = mock.MagicMock()
+    broker.logger = logging.getLogger('broker')
+    broker.save = mock.MagicMock()
+    return broker
 
 
 def test_watcher():
@@ -28,16 +161,553 @@ def test_watcher():
     test the logic of the streaming of 
     new transaction from the TransactionWatcher
 
-    since the WalletMock generate up to 10 transaction everytime
-    list_incoming_transactions, we assert the new transactions
-    return by the watcher are never bigger then 10
-    if that would be the case, our logic is wrong
+    since the WalletMock mines a block of up to 9 transactions everytime
+    list_incoming_transactions is called, we assert the transactions
+    returned by the watcher that were not seen before are never more than 9
+    and that no transaction is ever missed.
+    The reorg window lists some transactions again, those are filtered by the broker
     """
 
     wallet = WalletMock()
     watcher = TransactionWatcher(wallet)
-    count = 0
-    for _ in range(3):
-        for tx in watcher.watch():
-            count += 1
-    assert count < 30
+    seen = set()
+    for _ in range(30):
+        new = {tx.id for tx in watcher.watch()} - seen
+        assert len(new) < 10
+        seen |= new
+    assert seen == {tx.id for tx in wallet._transactions}
+
+
+def test_watcher_cursor():
+    """
+    test that the watcher only lists the new blocks once
+    all the transactions of a watch have been consumed
+    """
+    txns = [TransactionMock(10, height=h) for h in range(100, 200, 10)]
+    wallet = ChainWalletMock(txns)
+    watcher = TransactionWatcher(wallet, min_blockheight=50, reorg_window=5)
+
+    assert len(list(watcher.watch())) == 10
+    assert wallet.requested_heights[-1] == 50
+    assert watcher.height == 190
+
+    # a partially consumed watch does not move the cursor
+    wallet._transactions.append(TransactionMock(10, height=200))
+    next(watcher.watch())
+    assert watcher.height == 190
+
+    assert len(list(watcher.watch())) == 2
+    assert wallet.requested_heights[-1] == 185
+    assert watcher.height == 200
+
+
+def test_watcher_cursor_locked():
+    """
+    test that the cursor never moves past a locked transaction
+    """
+    txns = [
+        TransactionMock(10, height=100),
+        TransactionMock(10, height=110, locked=True),
+        TransactionMock(10, height=120),
+        TransactionMock(10, height=130, from_addresses=['broker']),
+    ]
+    wallet = ChainWalletMock(txns)
+    watcher = TransactionWatcher(wallet, reorg_window=0)
+
+    assert len(list(watcher.watch())) == 2
+    assert watcher.height == 109
+
+
+class UnreadableTransaction(TransactionMock):
+
+    @property
+    def from_addresses(self):
+        raise IndexError('list index out of range')
+
+    @from_addresses.setter
+    def from_addresses(self, value):
+        pass
+
+
+def test_watcher_unreadable_transaction():
+    """
+    test that a transaction the wallet fails to read is skipped without dropping the others
+    and that the cursor doesn't move past it
+    """
+    txns = [
+        TransactionMock(10, height=100),
+        TransactionMock(10, height=101),
+        TransactionMock(10, height=102),
+        UnreadableTransaction(10, height=103),
+    ]
+    wallet = ChainWalletMock(txns)
+    watcher = TransactionWatcher(wallet, reorg_window=0)
+
+    assert list(watcher.watch()) == txns[:3]
+    assert watcher.height == 102
+
+
+def test_processed_transactions():
+    """
+    test the membership, pruning and serialization of the processed transactions store
+    """
+    ids = ['%064x' % i for i in range(5)]
+    store = ProcessedTransactions.from_legacy({ids[0]: True})
+    store.add(ids[1], 0)
+    store.add(ids[2], 100)
+    store.add(ids[3], 110)
+    assert ids[0] in store
+    assert ids[4] not in store
+
+    # an unconfirmed transaction moves to its block once confirmed
+    store.add(ids[1], 105)
+    store = ProcessedTransactions.load(store.dump())
+    assert len(store) == 4
+
+    store.prune(106)
+    assert ids[0] not in store
+    assert ids[1] not in store
+    assert ids[2] not in store
+    assert ids[3] in store
+
+    # unconfirmed transactions are never pruned
+    store.add(ids[4])
+    store.prune(200)
+    assert ids[4] in store
+    assert ids[3] not in store
+
+
+def test_pipeline_stage_concurrency():
+    """
+    test that a pipeline stage never runs more than its limit concurrently
+    and keeps track of the queued transactions
+    """
+    pipeline = Pipeline({'deploy': 2})
+    running = []
+    peak = []
+
+    def work():
+        with pipeline.stage('deploy'):
+            running.append(1)
+            peak.append(len(running))
+            gevent.sleep(0.01)
+            running.pop()
+
+    greenlets = [gevent.spawn(work) for _ in range(6)]
+    gevent.sleep(0)
+    assert pipeline.metrics()['deploy']['queued'] == 4
+    gevent.joinall(greenlets)
+
+    metrics = pipeline.metrics()['deploy']
+    assert max(peak) == 2
+    assert metrics['count'] == 6
+    assert metrics['queued'] == 0
+    assert metrics['running'] == 0
+
+
+def test_notary_client():
+    """
+    test the notary client against a local notary stub
+    """
+    with NotaryStub({'aa': {'threebot_id': 1}, 'bb': {'threebot_id': 2}}, failures=1) as notary:
+        metrics = Metrics()
+        client = NotaryClient(notary.url, backoff=0, metrics=metrics)
+
+        # the first request fails and is retried
+        assert client.get('aa') == {'threebot_id': 1}
+        assert notary.requests == 2
+        assert client.get('cc') is None
+
+        client.prefetch(['aa', 'bb', 'bb'])
+        assert notary.requests == 5
+        assert client.get('bb') == {'threebot_id': 2}
+        assert client.get('aa') == {'threebot_id': 1}
+        assert notary.requests == 5
+
+    # the prefetched gets don't hit the notary and are not timed
+    notary_stages = metrics.summary('grid_broker_stage_seconds')
+    assert notary_stages['notary']['count'] == 4
+    assert notary_stages['notary_prefetch']['count'] == 1
+
+
+def test_ttl_cache():
+    """
+    test expiry, lru eviction and counters of the TTLCache
+    """
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return key * 2
+
+    cache = TTLCache(ttl=60, size=2)
+    assert cache.get(1, lambda: load(1)) == 2
+    assert cache.get(1, lambda: load(1)) == 2
+    cache.get(2, lambda: load(2))
+    cache.get(1, lambda: load(1))
+    # 2 is the least recently used and gets evicted
+    cache.get(3, lambda: load(3))
+    cache.get(2, lambda: load(2))
+    assert loads == [1, 2, 3, 2]
+
+    cache.invalidate(2)
+    cache.get(2, lambda: load(2))
+    assert cache.stats() == {'hits': 2, 'misses': 5, 'invalidations': 1, 'size': 2}
+
+    cache = TTLCache(ttl=0, size=2)
+    cache.get(1, lambda: load(1))
+    cache.get(1, lambda: load(1))
+    assert cache.misses == 2
+
+
+def test_watcher_own_addresses():
+    """
+    test that the snapshot of our addresses is refreshed when the wallet generates a new address
+    """
+    wallet = ChainWalletMock([])
+    watcher = TransactionWatcher(wallet)
+    txns = [TransactionMock(10, height=1, from_addresses=['new'])]
+
+    selected, _ = watcher.filter(txns)
+    assert len(selected) == 1
+
+    wallet.addresses.append('new')
+    selected, _ = watcher.filter(txns)
+    assert len(selected) == 0
+
+
+def test_email_templates(tmp_path):
+    """
+    test that the compiled email templates render like str.format
+    and that unknown placeholders are refused at load
+    """
+    source = '<p>{name} owes 100% of {amount}</p>'
+    path = tmp_path / 'email.html'
+    path.write_text(source)
+
+    template = EmailTemplate(str(path), {'name', 'amount'})
+    data = {'name': 'bob', 'amount': 10, 'unused': 1}
+    assert template.render(data) == source.format(**data)
+
+    try:
+        EmailTemplate(str(path), {'name'})
+        assert False, "missing field should be refused"
+    except ValueError:
+        pass
+
+
+def test_validate_reservation():
+    """
+    test that invalid reservations are refused before they are deployed
+    """
+    valid = {'type': 'vm', 'size': 1, 'duration': 2, 'amount': 83300000000, 'location': 'freefarm'}
+    _validate_reservation(valid)
+
+    invalid = [
+        {'amount': 83300000000 - 1},
+        {'size': 3},
+        {'type': 'unknown'},
+        {'duration': 0},
+        {'location': ''},
+        {'type': 's3', 'location': 'freefarm'},
+    ]
+    for change in invalid:
+        data = dict(valid, **change)
+        try:
+            _validate_reservation(data)
+            assert False, "%s should be refused" % change
+        except ValidationError:
+            pass
+
+
+def test_reservation_index():
+    index = ReservationIndex()
+    index.rebuild([
+        ('a', {'type': 'vm', 'location': 'farm1', 'email': 'x@mail', 'expiryTimestamp': 30, 'amount': 10}, False),
+        ('b', {'type': 's3', 'location': 'farm1', 'email': 'y@mail', 'expiryTimestamp': 10, 'amount': 20}, False),
+        ('c', {'type': 'vm', 'location': 'farm2', 'email': 'x@mail', 'expiryTimestamp': 20, 'amount': 30}, True),
+    ])
+    assert len(index) == 3
+
+    result = index.query()
+    assert [r['name'] for r in result['reservations']] == ['b', 'c', 'a']
+    assert result['amounts'] == {'vm': 40, 's3': 20}
+
+    result = index.query({'type': 'vm', 'email': 'x@mail'})
+    assert [r['name'] for r in result['reservations']] == ['c', 'a']
+    assert index.query({'state': 'active', 'type': 'vm'})['total'] == 1
+    assert index.query({'location': 'farm3'})['total'] == 0
+    assert [r['name'] for r in index.query(expires_after=10, expires_before=30)['reservations']] == ['b', 'c']
+
+    result = index.query(page=2, page_size=2)
+    assert result['total'] == 3
+    assert [r['name'] for r in result['reservations']] == ['a']
+
+    # an extension moves the reservation in the expiry order and adds to its amount
+    index.update('b', reservation_record({'type': 's3', 'location': 'farm1', 'email': 'y@mail', 'expiryTimestamp': 40, 'amount': 20, 'extensionAmount': 5}))
+    assert len(index) == 3
+    assert [r['name'] for r in index.query()['reservations']] == ['c', 'a', 'b']
+    assert index.query({'type': 's3'})['amounts'] == {'s3': 25}
+
+    index.remove('c')
+    assert index.query({'email': 'x@mail'})['total'] == 1
+    assert index.query({'state': 'cleaned'})['total'] == 0
+
+    with pytest.raises(ValueError):
+        index.query({'password': 'secret'})
+
+
+def test_refund_queue():
+    queue = RefundQueue()
+    queue.add('tx1', 'addr1', 5 * DEFAULT_MINERFEE)
+    queue.add('tx2', 'addr2', 3 * DEFAULT_MINERFEE)
+    queue.add('tx3', 'addr1', 2 * DEFAULT_MINERFEE)
+    queue.add('tx1', 'addr1', 5 * DEFAULT_MINERFEE)
+    assert len(queue) == 3
+
+    # the refunds to the same address share a single payout
+    payouts = queue.payouts()
+    assert payouts == [('addr1', 6 * DEFAULT_MINERFEE, ['tx1', 'tx3']), ('addr2', 2 * DEFAULT_MINERFEE, ['tx2'])]
+
+    queue.paid(['tx1', 'tx3'], 'payout1')
+    assert queue.payouts() == [('addr2', 2 * DEFAULT_MINERFEE, ['tx2'])]
+    assert queue.get('tx3')['payoutTxId'] == 'payout1'
+
+    # pending refunds are kept when reloaded
+    queue = RefundQueue.load(queue.dump())
+    assert queue.payouts() == [('addr2', 2 * DEFAULT_MINERFEE, ['tx2'])]
+    assert queue.get('tx1')['payoutTxId'] == 'payout1'
+
+    assert queue.prune(time.time() - 60) == 0
+    assert queue.prune(time.time() + 60) == 2
+    assert 'tx1' not in queue
+    assert 'tx2' in queue
+
+
+def test_metrics():
+    histogram = Histogram(buckets=(0.1, 1, 10))
+    for value in (0.05, 0.5, 0.5, 5, 50):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.quantile(0.5) == 1
+    assert histogram.quantile(0.99) == 10
+
+    metrics = Metrics()
+    with metrics.time('stage_seconds', stage='notary'):
+        pass
+    metrics.inc('transactions_total', outcome='processed', type='vm')
+    metrics.inc('transactions_total', outcome='processed', type='vm')
+    assert metrics.summary('stage_seconds')['notary']['count'] == 1
+    assert metrics.counters('transactions_total') == {'processed,vm': 2}
+
+    dump = metrics.dump()
+    dump['gauges'].append({'name': 'in_flight', 'labels': {}, 'value': 3})
+    lines = prometheus_text(dump).splitlines()
+    assert '# TYPE stage_seconds histogram' in lines
+    assert 'stage_seconds_bucket{le="0.005",stage="notary"} 1' in lines
+    assert 'stage_seconds_bucket{le="+Inf",stage="notary"} 1' in lines
+    assert 'stage_seconds_count{stage="notary"} 1' in lines
+    assert '# TYPE transactions_total counter' in lines
+    assert 'transactions_total{outcome="processed",type="vm"} 2' in lines
+    assert 'in_flight 3' in lines
+
+
+def test_watch_scheduler():
+    scheduler = WatchScheduler(10, 60)
+    assert scheduler.due(0)
+    assert scheduler.should_list(100)
+    scheduler.done(0, 100, True)
+
+    # the height is polled every interval, the transactions only listed when it advanced
+    assert not scheduler.due(5)
+    assert scheduler.due(10)
+    assert not scheduler.should_list(100)
+    scheduler.done(10, 100, False)
+    assert scheduler.interval == 20
+    scheduler.done(30, 101, False)
+    scheduler.done(70, 101, False)
+    scheduler.done(150, 101, False)
+    assert scheduler.interval == 60
+
+    # an unknown height always lists
+    assert scheduler.should_list(None)
+
+    # new transactions tighten the interval again
+    scheduler.done(210, 102, True)
+    assert scheduler.interval == 10
+
+    # a notified block is listed right away, an old one is ignored
+    scheduler.notify(102)
+    assert not scheduler.due(211)
+    scheduler.notify(103)
+    assert scheduler.due(211)
+    assert scheduler.should_list(None)
+    scheduler.done(211, None, True)
+    assert not scheduler.notified
+    assert scheduler.height == 103
+
+
+def test_watch_undecodable_data():
+    """
+    data that is not a valid notary key is refunded
+    without keeping the other transactions of the block from being deployed
+    """
+    valid = TransactionMock(10 * DEFAULT_MINERFEE, data=b'abcd', height=1)
+    invalid = TransactionMock(10 * DEFAULT_MINERFEE, data=b'\xff\xfe', height=1)
+    wallet = ChainWalletMock([valid, invalid])
+    broker = create_broker(wallet)
+
+    deployed = []
+    broker._parse_tx_data = lambda tx: (1, {'type': 'vm', 'email': 'user@grid.tf', 'key': tx.data.decode('utf-8')})
+    broker._deploy = lambda tx, data, threebot_id: deployed.append(tx.id)
+
+    assert broker._watch_transactions() == 2
+    broker._notary.prefetch.assert_called_once_with(['abcd'])
+    assert deployed == [valid.id]
+    assert broker._refunds.get(invalid.id)['payoutTxId'] == 'payout1'
+    # the refund is paid without the miner fee
+    assert wallet.sent == [(9 * DEFAULT_MINERFEE / TFT_PRECISION, 'sender')]
+    assert valid.id in broker._processed and invalid.id in broker._processed
+    assert broker.data['lastHeight'] == 1
+
+
+def test_watch_failure_releases_transactions():
+    """
+    the transactions of a watch that fails are processed by the next watch
+    """
+    tx = TransactionMock(10 * DEFAULT_MINERFEE, data=b'abcd', height=1)
+    broker = create_broker(ChainWalletMock([tx]))
+    deployed = []
+    broker._parse_tx_data = lambda tx: (1, {'type': 'vm', 'email': 'user@grid.tf'})
+    broker._deploy = lambda tx, data, threebot_id: deployed.append(tx.id)
+
+    broker._notary.prefetch.side_effect = RuntimeError("notary down")
+    with pytest.raises(RuntimeError):
+        broker._watch_transactions()
+    assert not broker._in_flight
+    assert not deployed
+
+    broker._notary.prefetch.side_effect = None
+    assert broker._watch_transactions() == 1
+    assert deployed == [tx.id]
+
+
+def test_watch_extension_after_creation():
+    """
+    an extension paid in the same block as the reservation it extends
+    is only deployed once the reservation is
+    """
+    extension = TransactionMock(10 * DEFAULT_MINERFEE, data=b'extend', height=1)
+    creation = TransactionMock(10 * DEFAULT_MINERFEE, data=b'create', height=1)
+    broker = create_broker(ChainWalletMock([extension, creation]))
+    broker._notify_user = mock.MagicMock()
+    types = {extension.id: 'extension', creation.id: 'vm'}
+    broker._parse_tx_data = lambda tx: (1, {'type': types[tx.id], 'email': 'user@grid.tf'})
+
+    order = []
+
+    def deploy(tx, data, threebot_id):
+        gevent.sleep(0.05)
+        order.append(tx.id)
+
+    def extend(tx, data, threebot_id):
+        order.append(tx.id)
+        return '01/01/30', 'vm'
+
+    broker._deploy = deploy
+    broker._extend_reservation = extend
+    assert broker._watch_transactions() == 2
+    assert order == [creation.id, extension.id]
+
+
+def test_watch_tick_failure():
+    """
+    a failing watch backs off and lists the same blocks again at the next poll
+    """
+    broker = create_broker(ChainWalletMock([]))
+    broker._chain_height = lambda: 100
+    broker._watch_transactions = mock.MagicMock(side_effect=RuntimeError("wallet unreachable"))
+
+    with pytest.raises(RuntimeError):
+        broker._watch_tick()
+    assert not broker._scheduler.due(time.time() + WATCH_TICK)
+    assert broker._scheduler.should_list(100)
+
+    broker._watch_transactions = mock.MagicMock(return_value=0)
+    broker._scheduler._next = 0
+    broker._watch_tick()
+    broker._watch_transactions.assert_called_once_with()
+    assert not broker._scheduler.should_list(100)
+
+
+def test_chain_height_explorers():
+    broker = create_broker(ChainWalletMock([]))
+    broker._explorers_ = ['https://explorer1', 'https://explorer2']
+    response = mock.MagicMock()
+    response.json.return_value = {'height': 100}
+    broker._explorer_ = mock.MagicMock()
+    broker._explorer.get.side_effect = [IOError("unreachable"), response]
+
+    # the next explorer of the network is used when one can't be reached
+    assert broker._chain_height() == 100
+    assert [call[0][0] for call in broker._explorer.get.call_args_list] == [
+        'https://explorer1/explorer', 'https://explorer2/explorer']
+
+    broker._explorer.get.side_effect = IOError("unreachable")
+    assert broker._chain_height() is None
+
+
+def test_prometheus(monkeypatch):
+    """
+    test that the metrics of the other templates are exported without calling their services
+    """
+    other = {'histograms': [], 'counters': [], 'gauges': [{'name': 'other_gauge', 'labels': {}, 'value': 1}]}
+    monkeypatch.setitem(_collectors, 'other', lambda: other)
+    broker = create_broker(ChainWalletMock([]))
+
+    lines = broker.prometheus().splitlines()
+    assert 'other_gauge 1' in lines
+    assert 'grid_broker_pending_refunds 0' in lines
+    assert not broker.api.mock_calls
+
+    # a failing collector leaves the metrics of the broker
+    monkeypatch.setitem(_collectors, 'other', mock.MagicMock(side_effect=RuntimeError()))
+    lines = broker.prometheus().splitlines()
+    assert 'grid_broker_pending_refunds 0' in lines
+
+
+def test_update_wallet():
+    """
+    test that a new wallet is watched from its minimum height, with no processed transactions
+    """
+    broker = create_broker(ChainWalletMock([TransactionMock(10 * DEFAULT_MINERFEE, height=5)]), minHeight=2)
+    broker._parse_tx_data = lambda tx: None
+    broker._watch_transactions()
+    assert broker.data['lastHeight'] == 5
+    assert len(broker._processed) == 1
+
+    # other changes keep the cursor
+    broker.update_data({'webGateway': 'other'})
+    assert broker.data['lastHeight'] == 5
+
+    broker.update_data({'wallet': 'other', 'minHeight': 3})
+    assert broker._wallet_ is None
+    assert broker.data['lastHeight'] == 3
+    assert len(broker._processed) == 0
+    assert len(ProcessedTransactions.load(broker.data['processedTransactions'])) == 0
+
+    wallet = ChainWalletMock([])
+    broker._wallet_ = wallet
+    broker._watch_transactions()
+    assert wallet.requested_heights == [3]
+
+
+def test_lazy_http_sessions():
+    """
+    test that no http session is created before the broker needs one
+    """
+    broker = create_broker(ChainWalletMock([]))
+    assert broker._explorer_ is None
+    notary = NotaryClient('http://127.0.0.1:1')
+    assert notary._session_ is None
+    assert notary._session is notary._session
@@ -1,12 +1,28 @@
+import os
+import sys
 import time
-from requests.exceptions import HTTPError
+import heapq
+import random
+import re
+import gevent
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Group, Pool
+from collections import defaultdict, OrderedDict
+from requests.exceptions import HTTPError, ConnectionError as RequestsConnectionError, Timeout
+from functools import wraps
 from datetime import date
 from jumpscale import j
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.state import StateCheckError
-from zerorobot.template.decorator import retry
 from zerorobot.service_collection import ServiceNotFoundError
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))  # see grid_common/__init__.py
+
+from grid_common.catalog import CATALOG
+from grid_common.metrics import Metrics, register_collector
+from grid_common.placement import farm_nodes
+
 DAY = 86400
 WEEK = 604800
 DMVM_GUID = 'github.com/threefoldtech/0-templates/dm_vm/0.0.1'
@@ -16,6 +32,120 @@ NAMESPACE_GUID = 'github.com/threefoldtech/0-templates/namespace/0.0.1'
 
 DIRECTORY_URL = 'https://capacity.threefoldtoken.com'
 MIGRATION_TIMESTAMP = 1562670098 # date on which the expirationtimestamp migration is done
+SWEEP_MAX_INTERVAL = 3600  # maximum time the expiry sweeper sleeps
+SWEEP_RETRY_DELAY = 600  # time after which a failed cleanup is retried
+SWEEP_CONCURRENCY = 16  # maximum concurrent cleanups of expired reservations
+CLEANUP_CONCURRENCY = 4  # maximum concurrent uninstalls per robot
+ROBOT_POOL_SIZE = 64  # maximum amount of remote robot clients kept
+ROBOT_IDLE_TIMEOUT = 1800  # time after which an unused robot client is dropped
+ROBOT_HEALTH_INTERVAL = 300  # time after which a robot client is checked before being reused
+# reservation data kept in the reservation index of the grid broker
+INDEXED_FIELDS = ('type', 'size', 'location', 'email', 'threebotId', 'expiryTimestamp', 'amount', 'extensionAmount')
+
+
+# classes of the errors raised while installing a reservation
+PERMANENT = 'permanent'  # invalid reservation, retrying can't help
+TRANSIENT = 'transient'  # network errors
+CAPACITY = 'capacity'  # the selected node is out of capacity, the next attempt uses another node
+UNKNOWN = 'unknown'
+
+# amount of retries, first delay and backoff factor of every error class
+RETRY_BUDGETS = {
+    PERMANENT: {'retries': 0, 'delay': 0, 'backoff': 1},
+    TRANSIENT: {'retries': 5, 'delay': 2, 'backoff': 2},
+    CAPACITY: {'retries': 3, 'delay': 1, 'backoff': 1},
+    UNKNOWN: {'retries': 3, 'delay': 5, 'backoff': 2},
+}
+
+_CAPACITY_ERROR = re.compile(r'not enough|no space left|out of capacity|insufficient', re.IGNORECASE)
+
+# (reservation type, outcome) -> {'count', 'duration'} of the install attempts
+install_attempts = defaultdict(lambda: {'count': 0, 'duration': 0.0})
+
+# latency of the placement and of the installs of the deployed services
+_metrics = Metrics()
+
+
+def timed(stage, template=''):
+    return _metrics.time('reservation_stage_seconds', stage=stage, template=template)
+
+
+def dump_metrics():
+    """
+    dump the metrics shared by all the reservations
+    as {'histograms': [...], 'counters': [...], 'gauges': [...]}
+    """
+    metrics = _metrics.dump()
+    counters = metrics['counters']
+    for (typ, outcome), attempt in install_attempts.items():
+        labels = {'type': typ, 'outcome': outcome}
+        counters.append({'name': 'reservation_install_attempts_total', 'labels': labels, 'value': attempt['count']})
+        counters.append({'name': 'reservation_install_seconds_total', 'labels': labels, 'value': attempt['duration']})
+
+    pool = _robot_pool.stats()
+    for event in ('created', 'reused', 'evicted', 'unhealthy'):
+        counters.append({'name': 'reservation_robot_clients_total', 'labels': {'event': event}, 'value': pool[event]})
+    metrics['gauges'] = [
+        {'name': 'reservation_robot_clients', 'labels': {}, 'value': pool['size']},
+        {'name': 'reservation_pending_expiries', 'labels': {}, 'value': len(_expiry_index)},
+    ]
+    return metrics
+
+
+register_collector('reservation', dump_metrics)
+
+
+def classify_error(err):
+    """
+    get the class of an error raised during an install
+    """
+    if isinstance(err, (RequestsConnectionError, Timeout, ConnectionError, TimeoutError, gevent.Timeout)):
+        return TRANSIENT
+    if isinstance(err, HTTPError):
+        if err.response is not None and err.response.status_code < 500:
+            return PERMANENT
+        return TRANSIENT
+    # remote task errors only carry a message
+    if _CAPACITY_ERROR.search(str(err)):
+        return CAPACITY
+    if isinstance(err, ValueError):
+        return PERMANENT
+    return UNKNOWN
+
+
+def retry_policy(func):
+    """
+    retry a reservation install according to the budget of the class of the raised error,
+    with jittered exponential backoff. Every attempt is recorded in install_attempts
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        retries = defaultdict(int)
+        while True:
+            start = time.time()
+            try:
+                result = func(self, *args, **kwargs)
+            except Exception as err:
+                kind = classify_error(err)
+                _record_attempt(self.data['type'], kind, time.time() - start)
+                budget = RETRY_BUDGETS[kind]
+                if retries[kind] >= budget['retries']:
+                    raise
+                delay = budget['delay'] * budget['backoff'] ** retries[kind] * random.uniform(0.5, 1.5)
+                retries[kind] += 1
+                self.logger.warning("%s error during install: %s, retrying in %.1f seconds", kind, str(err), delay)
+                gevent.sleep(delay)
+                continue
+            _record_attempt(self.data['type'], 'ok', time.time() - start)
+            return result
+    return wrapper
+
+
+def _record_attempt(typ, outcome, duration):
+    attempt = install_attempts[(typ, outcome)]
+    attempt['count'] += 1
+    attempt['duration'] += duration
+
 
 class Reservation(TemplateBase):
 
@@ -24,12 +154,25 @@ class Reservation(TemplateBase):
 
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
-        self.recurring_action(self._cleanup, 3600*12)  # 12h
+        # cleanup is triggered by the shared expiry index instead of a timer per reservation,
+        # cleaned up reservations are only kept as a record and never swept again.
+        # They are still full services: zerorobot builds every service of its collection
+        # through TemplateBase.__init__, which loads its data and state, and offers no hook
+        # to register a stub that would only be hydrated on access.
+        if self.data.get('expiryTimestamp') and not self.data.get('cleanedTimestamp'):
+            _expiry_index.add(self)
+
+    def delete(self):
+        # the index must not keep sweeping a deleted reservation
+        _expiry_index.remove(self)
+        super().delete()
 
     def _migrate_service_expiry(self):
         creation = self.data.get('creationTimestamp')
         if creation and creation < MIGRATION_TIMESTAMP and not self.data.get('expiryTimestamp'):
                     self.data['expiryTimestamp'] = j.clients.tfchain.time.extend(self.data['creationTimestamp'], 1)
+                    # persist it so the migration only runs once per reservation
+                    self.save()
 
     def validate(self):
         # Check if this is an old installed service and if we need to set the expiryTimestamp
@@ -38,6 +181,8 @@ class Reservation(TemplateBase):
         for key in ['creationTimestamp', 'expiryTimestamp']:
             if not self.data.get(key):
                 raise ValueError("%s is not set" % key)
+        if not self.data.get('cleanedTimestamp'):
+            _expiry_index.add(self)
 
     def extend(self, duration, bot_expiration, tx_amount):
         try:
@@ -54,58 +199,110 @@ class Reservation(TemplateBase):
         if self.data["expiryTimestamp"] < time.time():
             raise ValueError("Reservation can't be extended after it has already expired")
 
-        amount = price(self.data['type'], self.data['size']) * duration
-        if tx_amount < amount:
-            raise ValueError("transaction amount is to low to deploy the workload. given: %s needed: %s" % (
-                             tx_amount, amount))
+        CATALOG.check_amount(self.data['type'], self.data['size'], duration, tx_amount)
 
         extended = j.clients.tfchain.time.extend(self.data["expiryTimestamp"], duration)
         if date.fromtimestamp(extended) > date.fromtimestamp(bot_expiration):
             raise ValueError("Reservation expiration can't exceed 3bot expiration")
 
         self.data["expiryTimestamp"] = extended
+        self.data["extensionAmount"] = self.data.get("extensionAmount", 0) + tx_amount
+        _expiry_index.add(self)
+        # read the connection info again on the next lookup
+        self.data['connectionInfoStale'] = True
         return {"expiryTimestamp": self.data["expiryTimestamp"], "type":self.data["type"]}
 
-    @retry((Exception), tries=4, delay=5, backoff=2, logger=None)
     def install(self):
-        deploy_map = {
+        # the reservation is validated before the deploy, there is no point in retrying an invalid reservation
+        install = self._deploy_map().get(self.data['type'])
+        if not install:
+            raise ValueError("unsupported reservation type %s size %s" % (self.data['type'], self.data['size']))
+
+        duration = j.clients.tfchain.time.months_diff(self.data["creationTimestamp"], self.data["expiryTimestamp"])
+        CATALOG.check_amount(self.data['type'], self.data['size'], duration, self.data['amount'])
+        CATALOG.check_location(self.data['type'], self.data['location'])
+
+        return self._install(install)
+
+    def _deploy_map(self):
+        return {
             'vm': self._install_vm,
             's3': self._install_s3,
             'namespace': self._install_namespace,
             'reverse_proxy': self._install_proxy,
         }
 
-        duration = j.clients.tfchain.time.months_diff(self.data["creationTimestamp"], self.data["expiryTimestamp"])
-        amount = price(self.data['type'], self.data['size']) * duration
-        if self.data['amount'] < amount:
-            raise ValueError("transaction amount is to low to deploy the workload. given: %s needed: %s" % (
-                             self.data['amount'], amount))
-
-        install = deploy_map.get(self.data['type'])
-        if not install:
-            raise ValueError("unsupported reservation type %s size %s" % (self.data['type'], self.data['size']))
-
+    @retry_policy
+    def _install(self, install):
         install_result = install(self.data['size'], self.data['organization'])
+        # keep the connection info so lookups don't need to query the deployed services
+        self.data['connectionInfo'] = install_result
         self.state.set('actions', 'install', 'ok')
         return install_result
 
+    def metrics(self):
+        """
+        get the latency histograms, install attempts and robot client counters shared by all the reservations
+        """
+        return dump_metrics()
+
+    def connection_info(self, refresh=False):
+        """
+        get the connection info of the reservation, saved when the install completed.
+        refresh reads it again from the deployed services
+        """
+        try:
+            self.state.check('actions', 'install', 'ok')
+        except StateCheckError:
+            raise ValueError("Reservation is not installed")
+        try:
+            self.state.check('actions', 'cleanup', 'ok')
+            raise ValueError("Reservation has expired")
+        except StateCheckError:
+            pass
+
+        if refresh or self.data.get('connectionInfoStale') or not self.data.get('connectionInfo'):
+            info = self._read_connection_info()
+            if info is None:
+                raise RuntimeError("fail to read the connection info of the reservation")
+            self.data['connectionInfo'] = info
+            self.data['connectionInfoStale'] = False
+            self.save()
+        return self.data['connectionInfo']
+
+    def _read_connection_info(self):
+        typ = self.data['type']
+        if typ == 'vm':
+            return self._vm_connect_info()
+        if typ == 's3':
+            return self._s3_connect_info()
+        if typ == 'namespace':
+            return self._namespace_connect_info()
+        if typ == 'reverse_proxy':
+            return self._proxy_connect_info()
+
     def _install_vm(self, size, organization=''):
-        if size == 1:
-            cpu = 1
-            memory = 2048
-            disk = 10
-        elif size == 2:
-            cpu = 2
-            memory = 4096
-            disk = 40
-        else:
-            raise ValueError('size can only be 1 or 2')
+        offer = CATALOG.offer('vm', size)
+        cpu = offer.cpu
+        memory = offer.memory
+        disk = offer.disk
+
+        # vms of the warm pool are created without organization in their kernel arguments
+        if not organization:
+            workload = self._claim_warm_workload(type='vm', size=size, farm=self.data['location'])
+            if workload:
+                self.data['createdServices'] = [{
+                    'robot': 'local',
+                    'id': workload['id'],
+                }]
+                return self._vm_connect_info()
 
         # For the location we support both nodeID and farm name. Check if the location is known
         # as a farm name in the directory and if so, deploy on the least used node. else it is a
         # nodeID, so just try that for the deploy
         location = self.data['location']
-        nodeID = get_least_used_node_from_farm_s3(location)
+        with timed('placement', 'dm_vm'):
+            nodeID = get_least_used_node_from_farm_s3(location, reserve={'cru': cpu, 'mru': memory / 1024, 'sru': disk})
         if nodeID is not None:
             location = nodeID
 
@@ -122,7 +319,15 @@ class Reservation(TemplateBase):
             data['kernelArgs'].append({'key': 'organization', 'name': 'organization', 'value': organization})
 
         vm = self.api.services.find_or_create(DMVM_GUID, self.data['txId'], data)
-        vm.schedule_action('install').wait(die=True)
+        try:
+            with timed('install', 'dm_vm'):
+                vm.schedule_action('install').wait(die=True)
+        except Exception as err:
+            if nodeID is not None and classify_error(err) == CAPACITY:
+                # the next attempt is placed on the next best node of the farm
+                farm_nodes(self.data['location']).exclude(nodeID)
+                vm.delete()
+            raise
         vm.schedule_action('enable_vnc').wait(die=True)
         self.logger.info("vm %s installed", self.data['txId'])
 
@@ -135,8 +340,22 @@ class Reservation(TemplateBase):
 
         return self._vm_connect_info()
 
+    def _claim_warm_workload(self, **spec):
+        """
+        claim a ready workload from the warm pool of the robot, None if there is none
+        """
+        pools = self.api.services.find(template_name='warm_pool')
+        if not pools:
+            return None
+        try:
+            return pools[0].schedule_action('claim', args=spec).wait(die=True).result
+        except Exception as err:
+            self.logger.warning("fail to claim a workload from the warm pool: %s", str(err))
+            return None
+
     def _vm_connect_info(self):
-        vm = self.api.services.get(template_uid=DMVM_GUID, name=self.data['txId'])
+        # the vm is named after the reservation, unless it was claimed from the warm pool
+        vm = self.api.services.guids.get(self.data['createdServices'][0]['id'])
         if vm is None:
             self.logger.error("Didn't find vm")
             return
@@ -161,75 +380,86 @@ class Reservation(TemplateBase):
             'vnc_addr': vnc_addr}
 
     def _install_s3(self, size, *args, **kwargs):
-        if size == 1:
-            disk = 500
-        elif size == 2:
-            disk = 1000
-        else:
-            raise ValueError('size can only be 1 or 2')
+        """
+        the s3 install is a chain of steps, the outputs of every completed step are saved
+        in installSteps so a retry or a robot restart resumes from the last completed step
+        """
+        disk = CATALOG.offer('s3', size).disk
+        steps = self.data.setdefault('installSteps', {})
+
+        if 's3' not in steps:
+            login = j.data.idgenerator.generateXCharID(8)
+            password = j.data.idgenerator.generateXCharID(16)
+            data = {
+                'farmerIyoOrg': self.data['location'],
+                'mgmtNic': {'id': '9bee8941b5717835', 'type': 'zerotier', 'ztClient': 'tf_public'},
+                'storageType': 'hdd',
+                'storageSize': disk,
+                'minioLogin': login,
+                'minioPassword': password,
+                'nsName': j.data.idgenerator.generateGUID(),
+                'dataShards': 4,
+                'parityShards': 2,
+            }
+            s3 = self.api.services.find_or_create(S3_GUID, self.data['txId'], data)
+            self._add_created_service('local', s3.guid)
+            with timed('install', 's3'):
+                task = s3.schedule_action('install').wait(die=True)
+            # credentails need to be returned from the task since they are currently
+            # different from the ones given when the S3 is created
+            # See https://github.com/threefoldtech/0-templates/issues/303
+            credentials = task.result
+            self._complete_step('s3', {'login': credentials['login'], 'password': credentials['password']})
+
+        if 'url' not in steps:
+            s3 = self.api.services.get(template_uid=S3_GUID, name=self.data['txId'])
+            task = s3.schedule_action('url')
+            task.wait()
+            if task.state != 'ok':
+                self.logger.error("error retrieving S3 url: \n%s", task.eco.trace)
+                raise RuntimeError("fail to retrieve the url of s3 %s" % self.data['txId'])
+            urls = task.result
+            self.logger.info("s3 installed at %s", urls)
+            self._complete_step('url', {'public': urls['public']})
+        url = steps['url']['public']
+
+        if 'proxy' not in steps:
+            rp_data = {
+                'webGateway': self.data['webGateway'],
+                'domain': '{}.wg01.grid.tf'.format(j.data.idgenerator.generateXCharID(6)),
+                'servers': [url],
+            }
+            reverse_proxy = self.api.services.find_or_create(REVERSE_PROXY_UID, 'rp-%s' % self.data['txId'], rp_data)
+            self._add_created_service('local', reverse_proxy.guid)
+            with timed('install', 'reverse_proxy'):
+                reverse_proxy.schedule_action('install').wait(die=True)
+            self._complete_step('proxy', {'domain': reverse_proxy.data['domain']})
+
+        if 'servers' not in steps:
+            reverse_proxy = self.api.services.get(template_uid=REVERSE_PROXY_UID, name='rp-%s' % self.data['txId'])
+            reverse_proxy.schedule_action('update_servers', args={'servers': [url]}).wait(die=True)
+            self._complete_step('servers', {})
 
-        # for now only allow 'freefarm.s3-storage'
-        if not self.data['location'] in ['freefarm.s3-storage']:
-            raise ValueError('can only deploy s3 in freefarm.s3-storage')
-
-        login = j.data.idgenerator.generateXCharID(8)
-        password = j.data.idgenerator.generateXCharID(16)
-        data = {
-            'farmerIyoOrg': self.data['location'],
-            'mgmtNic': {'id': '9bee8941b5717835', 'type': 'zerotier', 'ztClient': 'tf_public'},
-            'storageType': 'hdd',
-            'storageSize': disk,
-            'minioLogin': login,
-            'minioPassword': password,
-            'nsName': j.data.idgenerator.generateGUID(),
-            'dataShards': 4,
-            'parityShards': 2,
-        }
-        s3 = self.api.services.find_or_create(S3_GUID, self.data['txId'], data)
-        task = s3.schedule_action('install').wait(die=True)
-        credentials = task.result
-
-        task = s3.schedule_action('url')
-        task.wait()
-        if task.state != 'ok':
-            self.logger.error("error retrieving S3 url: \n%s", task.eco.trace)
-            return
-
-        urls = task.result
-        self.logger.info("s3 installed at %s", urls)
-
-        rp_data = {
-            'webGateway': self.data['webGateway'],
-            'domain': '{}.wg01.grid.tf'.format(j.data.idgenerator.generateXCharID(6)),
-            'servers': [urls['public']],
-        }
-        reverse_proxy = self.api.services.find_or_create(REVERSE_PROXY_UID, 'rp-%s' % s3.name, rp_data)
-        reverse_proxy.schedule_action('install').wait(die=True)
-        reverse_proxy.schedule_action('update_servers', args={'servers': [urls['public']]}).wait(die=True)
-
-        # save created services id
-        # used to delete the service during cleanup
-        self.data['createdServices'] = [
-            {
-                'robot': 'local',
-                'id': s3.guid,
-            },
-            {
-                'robot': 'local',
-                'id': reverse_proxy.guid,
-            },
-        ]
-
-        connection_info = self._s3_connect_info()
-        # credentails need to be returned from the task since they are currently
-        # different from the ones given when the S3 is created
-        # See https://github.com/threefoldtech/0-templates/issues/303
         return {
             'type': 's3',
-            'urls': connection_info['url'],
-            'login': credentials['login'],
-            'password': credentials['password'],
-            'domain': connection_info['domain']}
+            'urls': url,
+            'login': steps['s3']['login'],
+            'password': steps['s3']['password'],
+            'domain': steps['proxy']['domain']}
+
+    def _complete_step(self, step, outputs):
+        self.data['installSteps'][step] = outputs
+        self.save()
+
+    def _add_created_service(self, robot, guid):
+        """
+        save created service id as soon as it exists
+        used to delete the service during cleanup
+        """
+        created = self.data.setdefault('createdServices', [])
+        if not any(service['id'] == guid for service in created):
+            created.append({'robot': robot, 'id': guid})
+            self.save()
 
     def _s3_connect_info(self):
         s3 = self.api.services.get(template_uid=S3_GUID, name=self.data['txId'])
@@ -247,7 +477,7 @@ class Reservation(TemplateBase):
         rp = self.api.services.get(template_uid=REVERSE_PROXY_UID, name='rp-{}'.format(self.data['txId']))
         return {
             'type': 's3',
-            'url': urls['public'],
+            'urls': urls['public'],
             'login': s3.data['minioLogin_'],
             'password': s3.data['minioPassword_'],
             'domain': rp.data['domain']}
@@ -269,8 +499,26 @@ class Reservation(TemplateBase):
 
         location = self.data['location']
         disk_type = self.data['diskType']
-        node_detail = capacity_planning_namespace(location, disk_type)
-        robot = self.api.robots.get(node_detail['node_id'], node_detail['robot_address'])
+
+        workload = self._claim_warm_workload(
+            type='namespace', size=size, farm=location, disk_type=disk_type,
+            mode=self.data['namespaceMode'], password=self.data['password'])
+        if workload:
+            self.data['createdServices'] = [{
+                'robot': workload['robot'],
+                'id': workload['id'],
+            }]
+            return {
+                'type': 'namespace',
+                'ip': workload['ip'],
+                'port': workload['port'],
+                'password': workload['password'],
+                'nsName': workload['nsName'],
+            }
+
+        with timed('placement', 'namespace'):
+            node_detail = capacity_planning_namespace(location, disk_type, size)
+        robot = _robot_pool.get(self.api, node_detail['node_id'], node_detail['robot_address'])
 
         password = self.data['password'] if self.data['password'] else j.data.idgenerator.generateXCharID(16)
 
@@ -283,7 +531,15 @@ class Reservation(TemplateBase):
             'nsName': j.data.idgenerator.generateGUID(),
         }
         ns = robot.services.find_or_create(NAMESPACE_GUID, self.data['txId'], data)
-        ns.schedule_action('install').wait(die=True)
+        try:
+            with timed('install', 'namespace'):
+                ns.schedule_action('install').wait(die=True)
+        except Exception as err:
+            if node_detail['node_id'] != location and classify_error(err) == CAPACITY:
+                # the next attempt is placed on the next best node of the farm
+                farm_nodes(location).exclude(node_detail['node_id'])
+                ns.delete()
+            raise
         task = ns.schedule_action('connection_info').wait(die=True)
         connection_info = task.result
         self.logger.info("namespace %s installed", ns.name)
@@ -315,7 +571,8 @@ class Reservation(TemplateBase):
             'servers': servers,
         }
         reverse_proxy = self.api.services.find_or_create(REVERSE_PROXY_UID, self.data['txId'], data)
-        reverse_proxy.schedule_action('install').wait(die=True)
+        with timed('install', 'reverse_proxy'):
+            reverse_proxy.schedule_action('install').wait(die=True)
 
         # save created service id
         # used to delete the service during cleanup
@@ -324,14 +581,44 @@ class Reservation(TemplateBase):
             'id': reverse_proxy.guid,
         }]
 
+        return self._proxy_connect_info()
+
+    def _proxy_connect_info(self):
+        servers = self.data['backendUrls']
+        if not isinstance(servers, list):
+            servers = [servers]
+
         wg = self.api.services.get(name=self.data['webGateway'])
         return {
             'type': 'reverse_proxy',
-            'domain': data['domain'],
-            'backends': data['servers'],
+            'domain': self.data['domain'],
+            'backends': servers,
             'ip': wg.data['publicIps'][0],  # for now only one, we might support multiple IP in the future
         }
 
+    def _namespace_connect_info(self):
+        # the password and namespace name are only known by the install,
+        # reservations installed before the connection info was saved can't tell them
+        info = dict(self.data.get('connectionInfo') or {})
+        missing = [key for key in ('password', 'nsName') if not info.get(key)]
+        if missing:
+            raise ValueError("the %s of namespace %s were not saved by its install" % (
+                             " and ".join(missing), self.data['txId']))
+
+        created = self.data['createdServices'][0]
+        robot = _robot_pool.get(self.api, created['robot'])
+        ns = robot.services.guids.get(created['id'])
+        if ns is None:
+            self.logger.error("Didn't find namespace")
+            return
+        task = ns.schedule_action('connection_info').wait(die=True)
+        info.update({
+            'type': 'namespace',
+            'ip': task.result['ip'],
+            'port': task.result['port'],
+        })
+        return info
+
     def _cleanup(self):
         try:
             self.state.check('actions', 'cleanup', 'ok')
@@ -339,17 +626,68 @@ class Reservation(TemplateBase):
 
             if time.time()  > self.data["expiryTimestamp"]:
                 self.logger.info("reservation has expired, uninstalling")
-                for created_service in self.data.get('createdServices', []):
-                    self._cleanup_service(created_service['robot'], created_service['id'])
+                self._cleanup_services()
                 self.state.set('actions', 'cleanup', 'ok')
-
-    def _cleanup_service(self, robot, service_id):
-        if robot == 'local':
-            api = self.api
-        else:
-            api = self.api.robots.get(robot)
-
-
+                self._update_broker_index()
+            else:
+                # not expired yet, make sure the sweeper comes back at expiry
+                _expiry_index.add(self)
+                return
+        # also marks the reservations cleaned up before the marker existed, so they are skipped on the next start
+        if not self.data.get('cleanedTimestamp'):
+            self._compact()
+        _expiry_index.remove(self)
+
+    def _compact(self):
+        """
+        drop the data only needed while the reservation is installed
+        and mark it as cleaned up
+        """
+        for key in ('connectionInfo', 'connectionInfoStale', 'installSteps', 'password'):
+            self.data.pop(key, None)
+        self.data['cleanedTimestamp'] = int(time.time())
+        self.save()
+
+    def _update_broker_index(self):
+        # only send the fields kept in the reservation index of the brokers
+        data = {key: self.data.get(key) for key in INDEXED_FIELDS}
+        for broker in self.api.services.find(template_name='grid_broker'):
+            try:
+                broker.schedule_action('index_reservation', {'name': self.name, 'data': data, 'cleaned': True})
+            except Exception as err:
+                self.logger.error("fail to update the reservation index of broker %s: %s", broker.name, str(err))
+
+    def _cleanup_services(self):
+        """
+        uninstall all created services concurrently, with a bounded amount of uninstalls per robot.
+        Every uninstalled service is recorded so a failed or interrupted cleanup
+        only retries the remaining services
+        """
+        errors = []
+
+        def cleanup(created_service):
+            robot = created_service['robot']
+            try:
+                with _robot_semaphores[robot]:
+                    api = self.api if robot == 'local' else _robot_pool.get(self.api, robot)
+                    self._cleanup_service(api, created_service['id'])
+            except Exception as err:
+                self.logger.error("fail to uninstall service %s on robot %s: %s", created_service['id'], robot, str(err))
+                errors.append(err)
+                return
+            created_service['uninstalled'] = True
+            self.save()
+
+        group = Group()
+        for created_service in self.data.get('createdServices', []):
+            if not created_service.get('uninstalled'):
+                group.spawn(cleanup, created_service)
+        group.join()
+
+        if errors:
+            raise RuntimeError("fail to uninstall %d services of the reservation" % len(errors))
+
+    def _cleanup_service(self, api, service_id):
         service = api.services.guids.get(service_id)
         if not service:
             return # service not found
@@ -360,36 +698,203 @@ class Reservation(TemplateBase):
         service.delete()
 
 
-def _get_farm_nodes(farmname):
+class ExpiryIndex:
+    """
+    min-heap of the reservations on their expiry timestamp.
+    A single sweeper greenlet sleeps until the next reservation expires and
+    spawns the cleanup of the reservations that are due in a bounded pool,
+    so a stuck uninstall doesn't hold back the other expiries.
+    """
+
+    def __init__(self):
+        self._heap = []  # (expiryTimestamp, guid)
+        self._services = {}  # guid -> (expiryTimestamp, service)
+        self._cleaning = set()  # guids of the reservations being cleaned up
+        self._pool = Pool(SWEEP_CONCURRENCY)
+        self._wakeup = Event()
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._services)
+
+    def add(self, service, expiry=None):
+        """
+        add the reservation to the index or update its expiry
+        """
+        if expiry is None:
+            expiry = service.data['expiryTimestamp']
+        current = self._services.get(service.guid)
+        if current is not None and current[0] == expiry:
+            return
+        self._services[service.guid] = (expiry, service)
+        # outdated entries of the heap are skipped when popped
+        heapq.heappush(self._heap, (expiry, service.guid))
+        if self._heap[0][1] == service.guid:
+            self._wakeup.set()
+        if self._sweeper is None:
+            self._sweeper = gevent.spawn(self._sweep)
+
+    def remove(self, service):
+        self._services.pop(service.guid, None)
+        self._cleaning.discard(service.guid)
+
+    def next_expiry(self):
+        self._drop_outdated()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """
+        remove and return the reservations that have expired at now
+        """
+        due = []
+        while self.next_expiry() is not None and self._heap[0][0] < now:
+            _, guid = heapq.heappop(self._heap)
+            due.append(self._services.pop(guid)[1])
+        return due
+
+    def _drop_outdated(self):
+        while self._heap:
+            expiry, guid = self._heap[0]
+            current = self._services.get(guid)
+            if current is not None and current[0] == expiry:
+                return
+            heapq.heappop(self._heap)
+
+    def _sweep(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            for service in self.pop_due(now):
+                if service.guid in self._cleaning:
+                    # the previous cleanup is still running
+                    self.add(service, now + SWEEP_RETRY_DELAY)
+                    continue
+                self._cleaning.add(service.guid)
+                # waits for a free slot when the pool is full
+                self._pool.spawn(self._expire, service)
+
+            timeout = SWEEP_MAX_INTERVAL
+            next_expiry = self.next_expiry()
+            if next_expiry is not None:
+                timeout = min(timeout, max(0, next_expiry - time.time()) + 1)
+            self._wakeup.wait(timeout)
+
+    def _expire(self, service):
+        try:
+            service._cleanup()
+        except Exception as err:
+            service.logger.error("fail to cleanup expired reservation: %s", str(err))
+            # a reservation deleted during its cleanup is not retried
+            if service.guid in self._cleaning:
+                self.add(service, time.time() + SWEEP_RETRY_DELAY)
+        finally:
+            self._cleaning.discard(service.guid)
+
+
+_expiry_index = ExpiryIndex()
+
+class RobotPool:
     """
-    get a list of online nodes in the given farm
+    bounded pool of the clients of the remote robots, keyed by node id.
+    Clients idle for longer than idle_timeout are dropped, and a client is
+    health checked before being reused when it wasn't checked for health_interval
     """
-    return list(j.sal_zos.farm.get(farmname).filter_online_nodes())
 
+    def __init__(self, size, idle_timeout, health_interval):
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._health_interval = health_interval
+        self._clients = OrderedDict()  # node_id -> {'client', 'used', 'checked'}
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.unhealthy = 0
+
+    def get(self, api, node_id, address=None):
+        """
+        get the client of the robot of a node, address is needed if the robot is not known yet
+        """
+        now = time.time()
+        self._evict_idle(now)
+
+        entry = self._clients.get(node_id)
+        if entry is not None and now - entry['checked'] > self._health_interval:
+            if self._healthy(entry['client']):
+                entry['checked'] = now
+            else:
+                self.unhealthy += 1
+                del self._clients[node_id]
+                entry = None
+
+        if entry is not None:
+            self.reused += 1
+            entry['used'] = now
+            self._clients.move_to_end(node_id)
+            return entry['client']
+
+        if address:
+            client = api.robots.get(node_id, address)
+        else:
+            client = api.robots.get(node_id)
+        self.created += 1
+        self._clients[node_id] = {'client': client, 'used': now, 'checked': now}
+        while len(self._clients) > self._size:
+            self._clients.popitem(last=False)
+            self.evicted += 1
+        return client
+
+    def _evict_idle(self, now):
+        # clients are ordered from the least recently used
+        while self._clients:
+            node_id, entry = next(iter(self._clients.items()))
+            if now - entry['used'] < self._idle_timeout:
+                return
+            del self._clients[node_id]
+            self.evicted += 1
+
+    def _healthy(self, client):
+        try:
+            client.services.find(name='__healthcheck__')
+            return True
+        except Exception:
+            return False
+
+    def stats(self):
+        return {
+            'size': len(self._clients),
+            'created': self.created,
+            'reused': self.reused,
+            'evicted': self.evicted,
+            'unhealthy': self.unhealthy,
+        }
+
+
+_robot_pool = RobotPool(ROBOT_POOL_SIZE, ROBOT_IDLE_TIMEOUT, ROBOT_HEALTH_INTERVAL)
+
+# bound the concurrent uninstalls on every robot across all reservations
+_robot_semaphores = defaultdict(lambda: BoundedSemaphore(CLEANUP_CONCURRENCY))
 
-def get_least_used_node_from_farm_s3(farmname):
+
+def get_least_used_node_from_farm_s3(farmname, reserve=None):
     """
     get the node ID of the least used node in a given farm based on cru/mru/sru
+    reserve: resources to account on the selected node
     """
-    nodes = _get_farm_nodes(farmname)
-    if not nodes:
+    nodes = farm_nodes(farmname)
+    node = nodes.least_used('vm')
+    if node is None:
         return
-
-    def key(node):
-        return (-node['total_resources']['cru'],
-                -node['total_resources']['mru'],
-                -node['total_resources']['sru'],
-                node['used_resources']['cru'],
-                node['used_resources']['mru'],
-                node['used_resources']['sru'])
-    return sorted(nodes, key=key)[0]['node_id']
+    if reserve:
+        nodes.reserve(node['node_id'], **reserve)
+    return node['node_id']
 
 
-def capacity_planning_namespace(location, disk_type):
+def capacity_planning_namespace(location, disk_type, size=0):
     """
     get the node detail of the node or farm pointed by location
     if location is a node id, return this node detail
     if location is a farm name, return the least used node detail
+    size: disk space to account on the selected node of the farm
     """
     if disk_type == 'ssd':
         resource = 'sru'
@@ -408,50 +913,14 @@ def capacity_planning_namespace(location, disk_type):
             raise err
 
     # if it's not a node id, try as a farm name
-    nodes = _get_farm_nodes(location)
-    if not nodes:
+    nodes = farm_nodes(location)
+    node = nodes.least_used(resource)
+    if node is None:
         raise ValueError("no nodes found in farm %s" % location)
-
-    def key(node):
-        return (-node['total_resources'][resource],
-                node['used_resources'][resource])
-    return sorted(nodes, key=key)[0]
+    if size:
+        nodes.reserve(node['node_id'], **{resource: size})
+    return node
 
 
 def price(typ, size):
-    if typ == 's3':
-        return s3_price(size)
-    elif typ == 'vm':
-        return vm_price(size)
-    elif typ == 'namespace':
-        return namespace_price(size)
-    elif typ == 'reverse_proxy':
-        return proxy_price(size)
-    else:
-        raise ValueError("unsupported reservation type")
-
-
-def s3_price(size):
-    if size == 1:
-        return 41650000000.0
-    elif size == 2:
-        return 83300000000.0
-    else:
-        raise ValueError("size for s3 can only be 1 or 2")
-
-
-def vm_price(size):
-    if size == 1:
-        return 41650000000.0
-    elif size == 2:
-        return 83300000000.0
-    else:
-        raise ValueError("size for vm can only be 1 or 2")
-
-
-def namespace_price(size):
-    return size * 83300000.0
-
-
-def proxy_price(size):
-    return 10000000000
+    return CATALOG.price(typ, size)
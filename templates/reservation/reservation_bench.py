@@ -0,0 +1,124 @@
+"""
+benchmark of the start of a robot with a large history of reservations
+
+TemplateBase.__init__ is patched out, so the load time only measures the constructor
+and validate of the reservation template itself, not the start time of a robot
+which also loads the data and state of every service from disk.
+Cleaned up reservations are not lazily hydrated stubs, they only skip the expiry index.
+
+run with: python reservation_bench.py
+"""
+# the robot runs monkey patched by gevent
+from gevent import monkey
+monkey.patch_all()
+
+import time
+import tracemalloc
+from unittest import mock
+
+from zerorobot.template.base import TemplateBase
+from zerorobot.template.state import StateCheckError
+
+import reservation
+from reservation import Reservation, ExpiryIndex, MIGRATION_TIMESTAMP
+
+
+class StateMock:
+
+    def __init__(self, cleaned):
+        self._cleaned = cleaned
+
+    def check(self, category, tag, state):
+        if not self._cleaned:
+            raise StateCheckError("cleanup is not ok")
+
+    def set(self, category, tag, state):
+        self._cleaned = True
+
+
+def _init(self, name=None, guid=None, data=None):
+    self.name = name
+    self.guid = guid or name
+    self.data = data
+
+
+def _reservation_data(i, now, cleaned, marked, legacy_expiry):
+    data = {
+        'type': 'vm', 'size': 1, 'email': 'user%d@grid.tf' % i, 'txId': '%064x' % i,
+        'location': 'freefarm', 'organization': '', 'amount': 41650000000,
+        'createdServices': [{'robot': 'local', 'id': '%032x' % i}],
+    }
+    if cleaned:
+        data['creationTimestamp'] = now - 400 * 86400
+        data['expiryTimestamp'] = now - 370 * 86400
+        if legacy_expiry:
+            # created before the expiry timestamp existed
+            data['creationTimestamp'] = MIGRATION_TIMESTAMP - 86400
+            data['expiryTimestamp'] = 0
+        elif marked:
+            data['cleanedTimestamp'] = data['expiryTimestamp']
+        else:
+            data['connectionInfo'] = {'type': 'vm', 'robot_url': 'http://10.0.0.1:6600',
+                                      'zos_addr': '10.0.0.1:6379', 'vnc_addr': '1.1.1.1:5900'}
+    else:
+        data['creationTimestamp'] = now
+        data['expiryTimestamp'] = now + 30 * 86400
+        data['connectionInfo'] = {'type': 'vm', 'robot_url': 'http://10.0.0.1:6600',
+                                  'zos_addr': '10.0.0.1:6379', 'vnc_addr': '1.1.1.1:5900'}
+    return data
+
+
+def _start(count, active, marked, legacy_expiry):
+    """
+    create count reservations and validate them like the robot does on start, then run the first sweep
+    of the expiry index. returns the load time of the template, sweep time, amount of swept reservations
+    and peak memory
+    """
+    now = int(time.time())
+    legacy_every = int(1 / legacy_expiry) if legacy_expiry else 0
+    datas = []
+    for i in range(count):
+        cleaned = i >= count * active
+        datas.append(_reservation_data(i, now, cleaned, marked, cleaned and not marked and legacy_every and i % legacy_every == 0))
+
+    index = ExpiryIndex()
+    tracemalloc.start()
+    with mock.patch.object(TemplateBase, '__init__', _init), mock.patch.object(reservation, '_expiry_index', index):
+        start = time.perf_counter()
+        services = []
+        for i, data in enumerate(datas):
+            service = Reservation(name=data['txId'], data=data)
+            service.state = StateMock(i >= count * active)
+            service.save = lambda: None
+            service.validate()
+            services.append(service)
+        load = time.perf_counter() - start
+
+        # the work of the first wake up of the sweeper
+        start = time.perf_counter()
+        due = index.pop_due(time.time())
+        for service in due:
+            service._cleanup()
+        sweep = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if index._sweeper is not None:
+        index._sweeper.kill()
+    return load, sweep, len(due), peak
+
+
+def bench_startup(sizes=(10000, 100000), active=0.1, legacy_expiry=0.01):
+    """
+    compare the start of a robot whose cleaned up reservations are only known by their state,
+    with legacy reservations without expiry timestamp, to a robot whose cleaned up reservations
+    are marked in their data
+    """
+    print("start with %d%% active reservations: load (s) / first sweep (s) / swept / peak memory (MB)" % (active * 100))
+    for size in sizes:
+        for name, marked in (('unmarked', False), ('marked', True)):
+            load, sweep, swept, peak = _start(size, active, marked, legacy_expiry)
+            print("%d %s: %.3f / %.3f / %d / %.1f" % (size, name, load, sweep, swept, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    bench_startup()
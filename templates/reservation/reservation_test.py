@@ -0,0 +1,483 @@
+import time
+from collections import defaultdict
+from unittest.mock import MagicMock
+
+import gevent
+import pytest
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
+from zerorobot.template.base import TemplateBase
+from zerorobot.template.state import StateCheckError
+
+from reservation import ExpiryIndex, CATALOG, price
+from reservation import Reservation, retry_policy, RETRY_BUDGETS, CAPACITY, RobotPool, timed, dump_metrics, S3_GUID
+from reservation import CLEANUP_CONCURRENCY
+from grid_common.catalog import ValidationError
+from grid_common.placement import FarmNodes
+
+
+class ServiceMock:
+
+    def __init__(self, guid, expiry):
+        self.guid = guid
+        self.data = {'expiryTimestamp': expiry}
+
+
+def test_expiry_index():
+    """
+    test that the expiry index only returns the reservations that are due,
+    using their latest expiry
+    """
+    index = ExpiryIndex()
+    # don't start the sweeper, the test drives the index
+    index._sweeper = True
+    services = [ServiceMock(str(i), 100 + i * 10) for i in range(5)]
+    for service in services:
+        index.add(service)
+
+    # extend a reservation past the others
+    services[1].data['expiryTimestamp'] = 200
+    index.add(services[1])
+    index.remove(services[3])
+
+    assert index.next_expiry() == 100
+    assert [s.guid for s in index.pop_due(125)] == ['0', '2']
+    assert index.next_expiry() == 140
+    assert [s.guid for s in index.pop_due(1000)] == ['4', '1']
+    assert index.next_expiry() is None
+    assert len(index) == 0
+
+
+def test_expiry_index_sweep(monkeypatch):
+    """
+    test that a stuck cleanup doesn't hold back the other expired reservations
+    and that a deleted reservation is not swept anymore
+    """
+    monkeypatch.setattr(TemplateBase, 'delete', MagicMock(), raising=False)
+    index = ExpiryIndex()
+    monkeypatch.setattr('reservation._expiry_index', index)
+    stuck = Event()
+    cleaned = []
+
+    def reservation(guid, expiry):
+        service = Reservation.__new__(Reservation)
+        service.guid = guid
+        service.data = {'expiryTimestamp': expiry}
+        service.logger = MagicMock()
+        if guid == 'stuck':
+            service._cleanup = stuck.wait
+        else:
+            service._cleanup = lambda: cleaned.append(guid) or index.remove(service)
+        return service
+
+    now = time.time()
+    index.add(reservation('stuck', now - 20))
+    for i in range(5):
+        index.add(reservation(str(i), now - 10 + i))
+    deleted = reservation('deleted', now - 5)
+    index.add(deleted)
+    deleted.delete()
+
+    gevent.sleep(0.1)
+    assert cleaned == ['0', '1', '2', '3', '4']
+    assert len(index) == 0
+    stuck.set()
+
+
+def _node(node_id, total, used):
+    return {
+        'node_id': node_id,
+        'total_resources': {'cru': total, 'mru': total, 'sru': total, 'hru': total},
+        'used_resources': {'cru': used, 'mru': used, 'sru': used, 'hru': used},
+    }
+
+
+def test_farm_nodes_placement():
+    """
+    test that the placement picks the node with the most remaining capacity and
+    spreads consecutive reservations before the farm is reloaded
+    """
+    nodes = FarmNodes([_node('small', 4, 0), _node('big1', 8, 2), _node('big2', 8, 3)])
+    assert nodes.least_used('vm')['node_id'] == 'big1'
+
+    nodes.reserve('big1', cru=2, mru=2, sru=10)
+    assert nodes.least_used('vm')['node_id'] == 'big2'
+    # only the sru usage counts for a ssd namespace
+    assert nodes.least_used('hru')['node_id'] == 'big1'
+    assert nodes.least_used('sru')['node_id'] == 'big2'
+
+    # a node out of capacity is skipped
+    nodes.exclude('big2')
+    assert nodes.least_used('vm')['node_id'] == 'small'
+
+    assert FarmNodes([]).least_used('vm') is None
+
+
+def test_farm_nodes_remaining_capacity():
+    """
+    test that a big node which is almost full is not picked over an empty smaller one,
+    and that the reservations since the snapshot count against the remaining capacity
+    """
+    nodes = FarmNodes([_node('full', 16, 15), _node('empty', 8, 0), _node('half', 12, 6)])
+    assert nodes.least_used('vm')['node_id'] == 'empty'
+    assert nodes.least_used('hru')['node_id'] == 'empty'
+
+    nodes.reserve('empty', cru=3, mru=3, sru=3)
+    assert nodes.least_used('vm')['node_id'] == 'half'
+    nodes.reserve('half', cru=2, mru=2, sru=2)
+    assert nodes.least_used('vm')['node_id'] == 'empty'
+    nodes.reserve('empty', cru=4, mru=4, sru=4)
+    assert nodes.least_used('vm')['node_id'] == 'half'
+    # the hdd of the nodes is untouched, the empty node has the most left
+    assert nodes.least_used('hru')['node_id'] == 'empty'
+
+    # on the same remaining capacity the biggest node goes first
+    nodes = FarmNodes([_node('small', 4, 0), _node('big', 8, 4)])
+    assert nodes.least_used('vm')['node_id'] == 'big'
+
+
+def test_catalog():
+    """
+    test the prices and errors of the reservation catalog
+    """
+    assert price('vm', 2) == 83300000000.0
+    assert price('namespace', 10) == 833000000.0
+    assert price('reverse_proxy', 5) == 10000000000.0
+    assert CATALOG.offer('vm', 1).memory == 2048
+    CATALOG.check_location('s3', 'freefarm.s3-storage')
+    CATALOG.check_location('vm', 'anywhere')
+
+    for typ, size in [('vm', 3), ('unknown', 1)]:
+        try:
+            price(typ, size)
+            assert False, "%s of size %s should not have a price" % (typ, size)
+        except ValidationError:
+            pass
+
+    CATALOG.check_amount('vm', 2, 3, 3 * 83300000000)
+    try:
+        CATALOG.check_amount('vm', 2, 3, 3 * 83300000000 - 1)
+        assert False, "the amount of 3 months of vm of size 2 should be too low"
+    except ValidationError:
+        pass
+
+    assert CATALOG.quote([('s3', 1, 2), ('vm', 5, 1), ('namespace', 2, 3)]) == [
+        83300000000.0, None, 499800000.0]
+
+
+class ReservationMock:
+
+    def __init__(self, errors):
+        self.data = {'type': 'vm'}
+        self.logger = MagicMock()
+        self._errors = errors
+        self.calls = 0
+
+    @retry_policy
+    def install(self):
+        self.calls += 1
+        if self._errors:
+            raise self._errors.pop(0)
+        return 'ok'
+
+
+def test_retry_policy(monkeypatch):
+    """
+    test that install errors are retried according to their class
+    """
+    monkeypatch.setattr(gevent, 'sleep', lambda delay: None)
+
+    reservation = ReservationMock([ConnectionError(), RuntimeError("not enough memory on node"), RuntimeError()])
+    assert reservation.install() == 'ok'
+    assert reservation.calls == 4
+
+    # invalid reservations are never retried
+    reservation = ReservationMock([ValueError("size can only be 1 or 2")])
+    try:
+        reservation.install()
+        assert False, "permanent error should be raised"
+    except ValueError:
+        pass
+    assert reservation.calls == 1
+
+    retries = RETRY_BUDGETS[CAPACITY]['retries']
+    reservation = ReservationMock([RuntimeError("out of capacity")] * (retries + 1))
+    try:
+        reservation.install()
+        assert False, "capacity error should be raised once the budget is spent"
+    except RuntimeError:
+        pass
+    assert reservation.calls == retries + 1
+
+
+def test_robot_pool(monkeypatch):
+    """
+    test reuse, eviction and health checks of the robot clients
+    """
+    api = MagicMock()
+    api.robots.get.side_effect = lambda node_id, address=None: MagicMock(name=node_id)
+    pool = RobotPool(size=2, idle_timeout=60, health_interval=10)
+
+    client = pool.get(api, 'node1', 'http://node1:6600')
+    assert pool.get(api, 'node1') is client
+    pool.get(api, 'node2', 'http://node2:6600')
+    pool.get(api, 'node3', 'http://node3:6600')
+    assert pool.stats() == {'size': 2, 'created': 3, 'reused': 1, 'evicted': 1, 'unhealthy': 0}
+
+    # an unhealthy client is replaced
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 20)
+    pool._clients['node2']['client'].services.find.side_effect = ConnectionError()
+    assert pool.get(api, 'node2') is not None
+    assert pool.unhealthy == 1
+
+    # idle clients are dropped
+    monkeypatch.setattr(time, 'time', lambda: now + 100)
+    pool.get(api, 'node2')
+    assert pool.stats()['size'] == 1
+
+
+def test_dump_metrics():
+    with timed('placement', 'namespace'):
+        pass
+    metrics = dump_metrics()
+    placement = [h for h in metrics['histograms'] if h['labels'] == {'stage': 'placement', 'template': 'namespace'}]
+    assert placement[0]['count'] >= 1
+    assert sum(placement[0]['counts']) == placement[0]['count']
+    assert {g['name'] for g in metrics['gauges']} == {'reservation_robot_clients', 'reservation_pending_expiries'}
+
+
+def test_cleanup_marks_reservation(monkeypatch):
+    """
+    test that a cleaned up reservation is compacted and not swept again
+    """
+    index = ExpiryIndex()
+    monkeypatch.setattr('reservation._expiry_index', index)
+    service = Reservation.__new__(Reservation)
+    service.guid = 'a'
+    service.data = {'expiryTimestamp': 1, 'creationTimestamp': 1, 'password': 'secret', 'connectionInfo': {}}
+    service.state = MagicMock()  # state checks pass, the reservation was cleaned up before
+    service.save = MagicMock()
+    index.add(service)
+
+    service._cleanup()
+    assert service.data['cleanedTimestamp']
+    assert 'password' not in service.data
+    assert 'connectionInfo' not in service.data
+    assert len(index) == 0
+
+    service.validate()
+    assert len(index) == 0
+
+
+def _task(result=None):
+    task = MagicMock()
+    task.state = 'ok'
+    task.result = result
+    task.wait.return_value = task
+    return task
+
+
+def test_install_s3_checkpoints(monkeypatch):
+    """
+    test that a retried s3 install resumes after its last completed step
+    """
+    monkeypatch.setattr(gevent, 'sleep', lambda delay: None)
+    service = Reservation.__new__(Reservation)
+    service.data = {'type': 's3', 'size': 1, 'txId': 'tx', 'location': 'freefarm.s3-storage',
+                    'webGateway': 'gateway', 'organization': '', 'createdServices': []}
+    service.logger = MagicMock()
+    service.state = MagicMock()
+    service.save = MagicMock()
+    service.api = MagicMock()
+
+    s3 = MagicMock()
+    s3.guid = 's3-guid'
+    s3_actions = {'install': _task({'login': 'login', 'password': 'password'}),
+                  'url': _task({'public': 'http://10.0.0.1:9000'})}
+    s3.schedule_action.side_effect = lambda action, args=None: s3_actions[action]
+
+    proxy = MagicMock()
+    proxy.guid = 'proxy-guid'
+    proxy.data = {'domain': 'abc.wg01.grid.tf'}
+    proxy_install = _task()
+    tracked_at_failure = []
+
+    def proxy_wait(die=False):
+        # the first install of the reverse proxy fails, after the s3 is installed
+        if not tracked_at_failure:
+            tracked_at_failure.extend(s['id'] for s in service.data['createdServices'])
+            raise RuntimeError("gateway unreachable")
+        return proxy_install
+    proxy_install.wait.side_effect = proxy_wait
+    proxy.schedule_action.side_effect = lambda action, args=None: proxy_install if action == 'install' else _task()
+
+    def find(template_uid, name, data=None):
+        return s3 if template_uid == S3_GUID else proxy
+    service.api.services.find_or_create.side_effect = find
+    service.api.services.get.side_effect = lambda template_uid, name: find(template_uid, name)
+
+    result = service._install(service._install_s3)
+    assert result['login'] == 'login'
+    assert result['urls'] == 'http://10.0.0.1:9000'
+    assert result['domain'] == 'abc.wg01.grid.tf'
+
+    # the s3 is only installed and asked for its url once
+    assert [call[0][0] for call in s3.schedule_action.call_args_list] == ['install', 'url']
+    assert proxy_install.wait.call_count == 2
+    # the s3 is already tracked for the cleanup when the install fails
+    assert 's3-guid' in tracked_at_failure
+    assert service.data['createdServices'] == [{'robot': 'local', 'id': 's3-guid'}, {'robot': 'local', 'id': 'proxy-guid'}]
+    assert set(service.data['installSteps']) == {'s3', 'url', 'proxy', 'servers'}
+
+
+def _cleanup_reservation(created_services):
+    service = Reservation.__new__(Reservation)
+    service.data = {'createdServices': created_services}
+    service.logger = MagicMock()
+    service.save = MagicMock()
+    service.api = MagicMock()
+    return service
+
+
+def test_cleanup_services_robot_limit(monkeypatch):
+    """
+    test that the uninstalls run concurrently, with at most CLEANUP_CONCURRENCY per robot
+    """
+    monkeypatch.setattr('reservation._robot_semaphores', defaultdict(lambda: BoundedSemaphore(CLEANUP_CONCURRENCY)))
+    monkeypatch.setattr('reservation._robot_pool', MagicMock())
+    created = [{'robot': robot, 'id': '%s-%d' % (robot, i)} for robot in ('local', 'node1') for i in range(10)]
+    service = _cleanup_reservation(created)
+
+    running = defaultdict(int)
+    peaks = defaultdict(int)
+
+    def cleanup_service(api, service_id):
+        robot = service_id.split('-')[0]
+        running[robot] += 1
+        peaks[robot] = max(peaks[robot], running[robot])
+        gevent.sleep(0.01)
+        running[robot] -= 1
+    service._cleanup_service = cleanup_service
+
+    service._cleanup_services()
+    assert peaks == {'local': CLEANUP_CONCURRENCY, 'node1': CLEANUP_CONCURRENCY}
+    assert all(s['uninstalled'] for s in created)
+
+
+def test_cleanup_services_failure(monkeypatch):
+    """
+    test that a failing uninstall doesn't block the others
+    and that a retried cleanup only uninstalls the remaining services
+    """
+    monkeypatch.setattr('reservation._robot_semaphores', defaultdict(lambda: BoundedSemaphore(CLEANUP_CONCURRENCY)))
+    created = [{'robot': 'local', 'id': str(i)} for i in range(5)]
+    service = _cleanup_reservation(created)
+
+    calls = []
+    failing = {'2'}
+
+    def cleanup_service(api, service_id):
+        calls.append(service_id)
+        if service_id in failing:
+            raise RuntimeError("robot unreachable")
+    service._cleanup_service = cleanup_service
+
+    with pytest.raises(RuntimeError):
+        service._cleanup_services()
+    assert sorted(calls) == ['0', '1', '2', '3', '4']
+    assert [s['id'] for s in created if s.get('uninstalled')] == ['0', '1', '3', '4']
+
+    calls.clear()
+    failing.clear()
+    service._cleanup_services()
+    assert calls == ['2']
+    assert all(s['uninstalled'] for s in created)
+
+
+class InstalledState:
+    """
+    state of an installed reservation, cleaned up once cleaned is set
+    """
+
+    def __init__(self, cleaned=False):
+        self.cleaned = cleaned
+
+    def check(self, category, tag, state):
+        if tag == 'cleanup' and not self.cleaned:
+            raise StateCheckError("cleanup is not ok")
+
+    def set(self, category, tag, state):
+        if tag == 'cleanup':
+            self.cleaned = True
+
+
+def _namespace_reservation(monkeypatch, connection_info):
+    service = Reservation.__new__(Reservation)
+    service.guid = 'ns'
+    service.data = {'type': 'namespace', 'size': 1, 'txId': 'tx', 'location': 'freefarm',
+                    'creationTimestamp': 1, 'expiryTimestamp': time.time() + 86400,
+                    'createdServices': [{'robot': 'node1', 'id': 'ns-guid'}]}
+    if connection_info is not None:
+        service.data['connectionInfo'] = connection_info
+    service.logger = MagicMock()
+    service.state = InstalledState()
+    service.save = MagicMock()
+    service.api = MagicMock()
+
+    ns = MagicMock()
+    ns.schedule_action.return_value.wait.return_value.result = {'ip': '10.0.0.2', 'port': 9901}
+    robot = MagicMock()
+    robot.services.guids.get.return_value = ns
+    pool = MagicMock()
+    pool.get.return_value = robot
+    monkeypatch.setattr('reservation._robot_pool', pool)
+    monkeypatch.setattr('reservation._expiry_index', MagicMock())
+    return service, ns
+
+
+def test_connection_info(monkeypatch):
+    """
+    test that the saved connection info is returned without remote calls,
+    and read again from the namespace on refresh or after an extend
+    """
+    saved = {'type': 'namespace', 'ip': '10.0.0.1', 'port': 9900, 'password': 'secret', 'nsName': 'name'}
+    service, ns = _namespace_reservation(monkeypatch, dict(saved))
+
+    assert service.connection_info() == saved
+    assert not ns.schedule_action.called
+
+    info = service.connection_info(refresh=True)
+    assert (info['ip'], info['port']) == ('10.0.0.2', 9901)
+    # the credentials only known by the install are kept
+    assert (info['password'], info['nsName']) == ('secret', 'name')
+    assert service.data['connectionInfo'] == info
+    ns.schedule_action.assert_called_once_with('connection_info')
+
+    monkeypatch.setattr('reservation.j.clients.tfchain.time.extend', lambda timestamp, months: timestamp + months * 30 * 86400)
+    service.extend(1, time.time() + 365 * 86400, price('namespace', 1))
+    assert service.data['connectionInfoStale']
+    ns.schedule_action.return_value.wait.return_value.result = {'ip': '10.0.0.3', 'port': 9902}
+    assert service.connection_info()['ip'] == '10.0.0.3'
+    assert not service.data['connectionInfoStale']
+    assert ns.schedule_action.call_count == 2
+
+
+def test_connection_info_errors(monkeypatch):
+    """
+    test that the connection info of a cleaned up reservation or of a namespace
+    installed before its credentials were saved is refused
+    """
+    service, ns = _namespace_reservation(monkeypatch, {'type': 'namespace', 'password': 'secret', 'nsName': 'name'})
+    service.data['expiryTimestamp'] = time.time() - 1
+    service._cleanup_services = MagicMock()
+    service._update_broker_index = MagicMock()
+    service._cleanup()
+    assert 'connectionInfo' not in service.data
+    with pytest.raises(ValueError, match='expired'):
+        service.connection_info()
+
+    service, ns = _namespace_reservation(monkeypatch, None)
+    with pytest.raises(ValueError, match='password and nsName'):
+        service.connection_info(refresh=True)
+    assert not ns.schedule_action.called
@@ -1,10 +1,30 @@
+import os
+import sys
+import time
+
 import sendgrid
-from sendgrid.helpers.mail import Email, Content, Mail
 
 from jumpscale import j
 from zerorobot.template.base import TemplateBase
 from zerorobot.service_collection import ServiceNotFoundError
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))  # see grid_common/__init__.py
+
+from grid_common.metrics import Metrics, register_collector
+
+FLUSH_INTERVAL = 5  # time in seconds between two flushes of the outbox
+BATCH_SIZE = 100  # maximum amount of emails sent in a single request
+MAX_ATTEMPTS = 8
+RETRY_DELAY = 30  # delay in seconds before the first retry of a failed email, doubled on every attempt
+CONTENT_TAG = '-content-'
+# sendgrid limits the size of the substitutions of a personalization,
+# bigger emails are sent on their own
+MAX_SUBSTITUTION_SIZE = 10000
+
+# time from the queueing of the emails to their acceptance by sendgrid, shared by all the clients
+_metrics = Metrics()
+register_collector('sendgrid_client', _metrics.dump)
+
 
 class SendgridClient(TemplateBase):
 
@@ -14,6 +34,7 @@ class SendgridClient(TemplateBase):
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         self._client = None
+        self.recurring_action(self._flush, FLUSH_INTERVAL)
 
     def validate(self):
         if not self.data.get('apiKey'):
@@ -26,9 +47,120 @@ class SendgridClient(TemplateBase):
         return self._client
 
     def send(self, sender, receiver, subject, content):
-        from_email = Email(sender)
-        to_email = Email(receiver)
-        content = Content("text/html", content)
-        mail = Mail(from_email, subject, to_email, content)
-        _ = self._sg.client.mail.send.post(request_body=mail.get())
-        self.logger.info('email send to %s', receiver)
+        """
+        queue an email in the outbox, it is sent by the next flush
+        """
+        self.data['outbox'].append({
+            'sender': sender,
+            'receiver': receiver,
+            'subject': subject,
+            'content': content,
+            'attempts': 0,
+            'nextAttempt': 0,
+            'queued': time.time(),
+        })
+        self.save()
+
+    def _flush(self):
+        """
+        send the emails of the outbox that are due, grouped per sender in batch requests
+        """
+        now = time.time()
+        senders = {}
+        for message in self.data['outbox']:
+            if message['nextAttempt'] <= now:
+                senders.setdefault(message['sender'], []).append(message)
+        if not senders:
+            return
+
+        done = set()
+        for sender, messages in senders.items():
+            batches = list(_batches(messages))
+            while batches:
+                batch = batches.pop(0)
+                try:
+                    self._sg.client.mail.send.post(request_body=_request_body(sender, batch))
+                except Exception as err:
+                    if _rejected(err):
+                        if len(batch) > 1:
+                            # sendgrid refuses the whole request for a single invalid email,
+                            # send the halves on their own to find it
+                            half = len(batch) // 2
+                            batches[:0] = [batch[:half], batch[half:]]
+                            continue
+                        # retrying can't help, the other emails of its batch are sent
+                        self.logger.error("email to %s rejected: %s", batch[0]['receiver'], str(err))
+                        done.add(id(batch[0]))
+                        _metrics.inc('sendgrid_emails_total', outcome='rejected')
+                        continue
+
+                    for message in batch:
+                        message['attempts'] += 1
+                        if message['attempts'] >= MAX_ATTEMPTS:
+                            self.logger.error("fail to send email to %s, giving up: %s", message['receiver'], str(err))
+                            done.add(id(message))
+                            _metrics.inc('sendgrid_emails_total', outcome='dropped')
+                        else:
+                            message['nextAttempt'] = now + RETRY_DELAY * 2 ** (message['attempts'] - 1)
+                    self.logger.warning("fail to send %d emails: %s", len(batch), str(err))
+                    continue
+
+                delivered = time.time()
+                for message in batch:
+                    done.add(id(message))
+                    self.logger.info('email send to %s', message['receiver'])
+                    _metrics.inc('sendgrid_emails_total', outcome='sent')
+                    # emails queued before the queue time was recorded have none
+                    if message.get('queued'):
+                        _metrics.observe('sendgrid_delivery_seconds', delivered - message['queued'])
+
+        # emails queued while flushing are kept
+        self.data['outbox'] = [m for m in self.data['outbox'] if id(m) not in done]
+        self.save()
+
+
+def _rejected(err):
+    """
+    tell if sendgrid refused a request because of its content, only errors of the server,
+    the rate limit and the network are worth a retry
+    """
+    status = getattr(err, 'status_code', None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def _batches(messages):
+    batch = []
+    for message in messages:
+        if len(message['content']) > MAX_SUBSTITUTION_SIZE:
+            yield [message]
+            continue
+        batch.append(message)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _request_body(sender, messages):
+    """
+    create the body of a sendgrid mail send request.
+    Every email is a personalization, their content is set through a substitution
+    """
+    if len(messages) == 1:
+        message = messages[0]
+        return {
+            'personalizations': [{'to': [{'email': message['receiver']}], 'subject': message['subject']}],
+            'from': {'email': sender},
+            'content': [{'type': 'text/html', 'value': message['content']}],
+        }
+
+    return {
+        'personalizations': [{
+            'to': [{'email': message['receiver']}],
+            'subject': message['subject'],
+            'substitutions': {CONTENT_TAG: message['content']},
+        } for message in messages],
+        'from': {'email': sender},
+        'content': [{'type': 'text/html', 'value': CONTENT_TAG}],
+    }
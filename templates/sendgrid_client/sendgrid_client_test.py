@@ -0,0 +1,149 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock
+
+import python_http_client
+
+from sendgrid_client import SendgridClient, CONTENT_TAG, _metrics
+from grid_common.metrics import collect
+
+
+def _receivers(body):
+    return {to['email'] for personalization in body['personalizations'] for to in personalization['to']}
+
+
+class SendgridStub:
+    """
+    local http server that records the mail send requests like the sendgrid API
+    status: http status returned by the next requests
+    rejected: receivers for which the whole request is refused with a 400 like sendgrid does
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.status = 202
+        self.rejected = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                body = json.loads(body)
+                stub.requests.append((self.path, body))
+                self.send_response(400 if _receivers(body) & stub.rejected else stub.status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _client(url):
+    client = SendgridClient.__new__(SendgridClient)
+    client.data = {'apiKey': 'key', 'outbox': []}
+    client.logger = MagicMock()
+    client.save = MagicMock()
+    client._client = MagicMock()
+    client._client.client = python_http_client.Client(host=url, version=3)
+    return client
+
+
+def test_outbox_batches():
+    """
+    test that queued emails are sent per sender in a single request
+    """
+    with SendgridStub() as stub:
+        client = _client(stub.url)
+        for i in range(3):
+            client.send('broker@grid.tf', 'user%d@mail.com' % i, 'subject %d' % i, '<p>%d</p>' % i)
+        client.send('other@grid.tf', 'user@mail.com', 'subject', '<p>other</p>')
+        assert len(client.data['outbox']) == 4
+
+        client._flush()
+        assert client.data['outbox'] == []
+        assert len(stub.requests) == 2
+
+        path, body = stub.requests[0]
+        assert path == '/v3/mail/send'
+        assert body['content'] == [{'type': 'text/html', 'value': CONTENT_TAG}]
+        assert [p['substitutions'][CONTENT_TAG] for p in body['personalizations']] == ['<p>0</p>', '<p>1</p>', '<p>2</p>']
+        assert body['personalizations'][2]['to'] == [{'email': 'user2@mail.com'}]
+
+        _, body = stub.requests[1]
+        assert body['content'] == [{'type': 'text/html', 'value': '<p>other</p>'}]
+
+
+def test_outbox_rejected_email():
+    """
+    test that an email sendgrid refuses doesn't keep the other emails of its batch from being sent
+    """
+    with SendgridStub() as stub:
+        client = _client(stub.url)
+        stub.rejected.add('not an email')
+        for i in range(8):
+            client.send('broker@grid.tf', 'not an email' if i == 5 else 'user%d@mail.com' % i, 'subject', '<p>%d</p>' % i)
+
+        client._flush()
+        assert client.data['outbox'] == []
+        accepted = [body for _, body in stub.requests if not _receivers(body) & stub.rejected]
+        sent = [receiver for body in accepted for receiver in _receivers(body)]
+        assert sorted(sent) == sorted('user%d@mail.com' % i for i in range(8) if i != 5)
+        # halving the batch finds the rejected email in a few requests
+        assert len(stub.requests) <= 8
+        client.logger.error.assert_called_once()
+
+
+def test_outbox_retry():
+    """
+    test that failed emails stay in the outbox until the retry delay is over
+    """
+    with SendgridStub() as stub:
+        client = _client(stub.url)
+        stub.status = 500
+        client.send('broker@grid.tf', 'user@mail.com', 'subject', 'content')
+        client._flush()
+        assert len(client.data['outbox']) == 1
+        assert client.data['outbox'][0]['attempts'] == 1
+
+        # not due yet
+        stub.status = 202
+        client._flush()
+        assert len(stub.requests) == 1
+
+        client.data['outbox'][0]['nextAttempt'] = 0
+        client._flush()
+        assert len(stub.requests) == 2
+        assert client.data['outbox'] == []
+
+
+def test_delivery_latency():
+    """
+    test that the time from the queueing to the acceptance by sendgrid is recorded and exported
+    """
+    with SendgridStub() as stub:
+        client = _client(stub.url)
+        before = _metrics.summary('sendgrid_delivery_seconds').get('', {}).get('count', 0)
+        client.send('broker@grid.tf', 'user@mail.com', 'subject', 'content')
+        client.data['outbox'][0]['queued'] -= 20
+        # an email queued before the queue time was recorded
+        client.data['outbox'].append(dict(client.data['outbox'][0], queued=0))
+        client._flush()
+
+    delivery = _metrics.summary('sendgrid_delivery_seconds')['']
+    assert delivery['count'] == before + 1
+    assert delivery['p99'] >= 20
+    assert any(h['name'] == 'sendgrid_delivery_seconds' for h in collect()['histograms'])
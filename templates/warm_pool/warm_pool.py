@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+
+from jumpscale import j
+from zerorobot.template.base import TemplateBase
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))  # see grid_common/__init__.py
+
+from grid_common.catalog import CATALOG
+from grid_common.placement import farm_nodes
+
+DMVM_GUID = 'github.com/threefoldtech/0-templates/dm_vm/0.0.1'
+NAMESPACE_GUID = 'github.com/threefoldtech/0-templates/namespace/0.0.1'
+REFILL_INTERVAL = 60  # time in seconds between two refills of the pool
+
+
+class WarmPool(TemplateBase):
+    """
+    keeps pre-created vm and namespace workloads ready to be claimed by reservations,
+    so a reservation doesn't wait for the full deploy of its workload
+    """
+
+    version = '0.0.1'
+    template_name = "warm_pool"
+
+    def __init__(self, name, guid=None, data=None):
+        super().__init__(name=name, guid=guid, data=data)
+        self.recurring_action(self._refill, REFILL_INTERVAL)
+
+    def validate(self):
+        for target in self.data['targets']:
+            if target['type'] not in ('vm', 'namespace'):
+                raise ValueError("warm pool only supports vm and namespace, not %s" % target['type'])
+            if target['type'] == 'namespace' and target['diskType'] not in ('ssd', 'hdd'):
+                raise ValueError("diskType of a namespace target can only be 'ssd' or 'hdd'")
+
+    def claim(self, type, size, farm, disk_type='', mode='', password=''):
+        """
+        take a ready workload out of the pool, None if there is none for this type, size and farm.
+        Workloads past idleExpiry are left to the next refill, which removes them.
+        The password of a namespace is replaced by the given one or a new random one
+        """
+        spec = (type, size, farm, disk_type, mode)
+        now = time.time()
+        for i, workload in enumerate(self.data['workloads']):
+            if _spec(workload) == spec and not self._expired(workload, now):
+                # remove the workload before any call that could yield, so it is never claimed twice
+                del self.data['workloads'][i]
+                self.save()
+                break
+        else:
+            return None
+
+        self.logger.info("%s %s claimed from the warm pool", type, workload['id'])
+        if type != 'namespace':
+            return workload
+        try:
+            return self._claim_namespace(workload, password or j.data.idgenerator.generateXCharID(16))
+        except Exception:
+            # don't leave a namespace with unknown credentials behind
+            self._remove(workload)
+            raise
+
+    def _claim_namespace(self, workload, password):
+        robot = self.api.robots.get(workload['robot'], workload['robotAddress'])
+        ns = robot.services.guids.get(workload['id'])
+        # rotate the password so nobody who could see the pool knows it
+        ns.schedule_action('update_data', args={'data': {'password': password}}).wait(die=True)
+        task = ns.schedule_action('connection_info').wait(die=True)
+        claimed = dict(workload)
+        claimed['password'] = password
+        claimed['ip'] = task.result['ip']
+        claimed['port'] = task.result['port']
+        return claimed
+
+    def _refill(self):
+        self._expire()
+        for target in self.data['targets']:
+            spec = _spec(target)
+            missing = target['count'] - sum(1 for w in self.data['workloads'] if _spec(w) == spec)
+            for _ in range(missing):
+                try:
+                    workload = self._create(target)
+                except Exception as err:
+                    self.logger.error("fail to create %s for the warm pool: %s", target['type'], str(err))
+                    break
+                workload.update({
+                    'type': target['type'],
+                    'size': target['size'],
+                    'farm': target['farm'],
+                    'diskType': target['diskType'],
+                    'mode': target['mode'],
+                    'created': time.time(),
+                })
+                self.data['workloads'].append(workload)
+                self.save()
+
+    def _expire(self):
+        """
+        remove the workloads that stayed unclaimed for longer than idleExpiry
+        """
+        now = time.time()
+        for workload in list(self.data['workloads']):
+            if not self._expired(workload, now):
+                continue
+            if workload not in self.data['workloads']:
+                # claimed while the previous workload was being removed
+                continue
+            self.data['workloads'].remove(workload)
+            self.save()
+            self._remove(workload)
+
+    def _expired(self, workload, now):
+        return now - workload['created'] >= self.data['idleExpiry']
+
+    def _remove(self, workload):
+        try:
+            if workload['robot'] == 'local':
+                api = self.api
+            else:
+                api = self.api.robots.get(workload['robot'], workload['robotAddress'])
+            service = api.services.guids.get(workload['id'])
+            if service:
+                service.schedule_action('uninstall').wait(die=True)
+                service.delete()
+        except Exception as err:
+            self.logger.error("fail to remove workload %s: %s", workload['id'], str(err))
+
+    def _create(self, target):
+        # place on the same snapshot of the farm as the reservations, so the pool and the
+        # reservations account the resources of each other until the farm is reloaded
+        nodes = farm_nodes(target['farm'])
+        name = 'warm-%s' % j.data.idgenerator.generateXCharID(12)
+        if target['type'] == 'vm':
+            return self._create_vm(name, target, nodes)
+        return self._create_namespace(name, target, nodes)
+
+    def _create_vm(self, name, target, nodes):
+        offer = CATALOG.offer('vm', target['size'])
+        node = nodes.least_used('vm')
+        if node is None:
+            raise ValueError("no nodes found in farm %s" % target['farm'])
+        nodes.reserve(node['node_id'], cru=offer.cpu, mru=offer.memory / 1024, sru=offer.disk)
+
+        data = {
+            'cpu': offer.cpu,
+            'disks': [{'diskType': 'ssd', 'label': 'cache', 'size': offer.disk}],
+            'image': 'zero-os:master',
+            'kernelArgs': [{'key': 'development', 'name': 'developmet'}],
+            'memory': offer.memory,
+            'mgmtNic': {'id': '9bee8941b5717835', 'type': 'zerotier', 'ztClient': 'tf_public'},
+            'nodeId': node['node_id'],
+        }
+        vm = self.api.services.create(DMVM_GUID, name, data)
+        vm.schedule_action('install').wait(die=True)
+        vm.schedule_action('enable_vnc').wait(die=True)
+        return {'robot': 'local', 'robotAddress': '', 'id': vm.guid, 'nsName': ''}
+
+    def _create_namespace(self, name, target, nodes):
+        resource = 'sru' if target['diskType'] == 'ssd' else 'hru'
+        node = nodes.least_used(resource)
+        if node is None:
+            raise ValueError("no nodes found in farm %s" % target['farm'])
+        nodes.reserve(node['node_id'], **{resource: target['size']})
+
+        robot = self.api.robots.get(node['node_id'], node['robot_address'])
+        data = {
+            'size': target['size'],
+            'diskType': target['diskType'],
+            'mode': target['mode'],
+            'public': False,
+            'password': j.data.idgenerator.generateXCharID(16),
+            'nsName': j.data.idgenerator.generateGUID(),
+        }
+        ns = robot.services.create(NAMESPACE_GUID, name, data)
+        ns.schedule_action('install').wait(die=True)
+        return {'robot': node['node_id'], 'robotAddress': node['robot_address'], 'id': ns.guid, 'nsName': data['nsName']}
+
+
+def _spec(workload):
+    return (workload['type'], workload['size'], workload['farm'], workload['diskType'], workload['mode'])
@@ -0,0 +1,185 @@
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+import warm_pool
+from warm_pool import WarmPool
+from grid_common.placement import FarmNodes
+
+
+def _workload(id, type='vm', size=1, farm='freefarm', robot='local', created=None):
+    if created is None:
+        created = time.time()
+    return {'type': type, 'size': size, 'farm': farm, 'diskType': '', 'mode': '',
+            'robot': robot, 'robotAddress': '', 'id': id, 'nsName': '', 'created': created}
+
+
+def _pool(workloads=(), targets=(), idle_expiry=3600):
+    pool = WarmPool.__new__(WarmPool)
+    pool.data = {'workloads': list(workloads), 'targets': list(targets), 'idleExpiry': idle_expiry}
+    pool.logger = MagicMock()
+    pool.save = MagicMock()
+    pool.api = MagicMock()
+    return pool
+
+
+def _node(node_id, total):
+    return {
+        'node_id': node_id,
+        'robot_address': 'http://%s:6600' % node_id,
+        'total_resources': {'cru': total, 'mru': total, 'sru': total * 10, 'hru': total * 10},
+        'used_resources': {'cru': 0, 'mru': 0, 'sru': 0, 'hru': 0},
+    }
+
+
+def _namespace_robot(fail=None):
+    """
+    robot whose namespace service answers the actions of a claim, except the fail action which raises
+    """
+    ns = MagicMock()
+
+    def schedule_action(action, args=None):
+        if action == fail:
+            raise RuntimeError("%s failed" % action)
+        task = MagicMock()
+        task.wait.return_value.result = {'ip': '10.0.0.1', 'port': 9900}
+        return task
+
+    ns.schedule_action.side_effect = schedule_action
+    robot = MagicMock()
+    robot.services.guids.get.return_value = ns
+    return robot, ns
+
+
+def test_claim():
+    """
+    test that a workload is only claimed once and only for its own spec
+    """
+    pool = _pool([_workload('a', size=2), _workload('b'), _workload('c')])
+
+    assert pool.claim('vm', 1, 'otherfarm') is None
+    assert pool.claim('vm', 1, 'freefarm')['id'] == 'b'
+    assert pool.claim('vm', 1, 'freefarm')['id'] == 'c'
+    assert pool.claim('vm', 1, 'freefarm') is None
+    assert [w['id'] for w in pool.data['workloads']] == ['a']
+
+
+def test_claim_namespace_rotates_password(monkeypatch):
+    """
+    test that the password of a claimed namespace is replaced before its connection info is returned
+    """
+    monkeypatch.setattr(warm_pool.j.data.idgenerator, 'generateXCharID', lambda size: 'x' * size)
+    pool = _pool([_workload('a', type='namespace', robot='node1'), _workload('b', type='namespace', robot='node1')])
+    robot, ns = _namespace_robot()
+    pool.api.robots.get.return_value = robot
+
+    claimed = pool.claim('namespace', 1, 'freefarm', password='secret')
+    assert claimed['password'] == 'secret'
+    assert (claimed['ip'], claimed['port']) == ('10.0.0.1', 9900)
+    ns.schedule_action.assert_any_call('update_data', args={'data': {'password': 'secret'}})
+
+    # without a password a random one is set
+    assert pool.claim('namespace', 1, 'freefarm')['password'] == 'x' * 16
+    assert not pool.data['workloads']
+
+
+def test_claim_namespace_failure():
+    """
+    test that a namespace whose password might have been rotated is removed when the claim fails
+    """
+    pool = _pool([_workload('a', type='namespace', robot='node1')])
+    robot, ns = _namespace_robot(fail='connection_info')
+    pool.api.robots.get.return_value = robot
+
+    with pytest.raises(RuntimeError):
+        pool.claim('namespace', 1, 'freefarm', password='secret')
+    ns.schedule_action.assert_any_call('uninstall')
+    ns.delete.assert_called_once_with()
+    assert not pool.data['workloads']
+
+
+def test_refill(monkeypatch):
+    """
+    test that the pool is refilled up to its targets, spread over the nodes of the farm
+    """
+    snapshot = FarmNodes([_node('node1', 100), _node('node2', 100)])
+    monkeypatch.setattr(warm_pool, 'farm_nodes', lambda farm: snapshot)
+    targets = [
+        {'type': 'vm', 'size': 1, 'farm': 'freefarm', 'diskType': '', 'mode': '', 'count': 3},
+        {'type': 'namespace', 'size': 50, 'farm': 'freefarm', 'diskType': 'hdd', 'mode': 'user', 'count': 1},
+    ]
+    pool = _pool([_workload('a', created=float('inf'))], targets)
+    robot, ns = _namespace_robot()
+    pool.api.robots.get.return_value = robot
+
+    pool._refill()
+    vms = [w for w in pool.data['workloads'] if w['type'] == 'vm']
+    namespaces = [w for w in pool.data['workloads'] if w['type'] == 'namespace']
+    assert len(vms) == 3 and len(namespaces) == 1
+    nodes = [call[0][2]['nodeId'] for call in pool.api.services.create.call_args_list]
+    assert sorted(nodes) == ['node1', 'node2']
+    # the namespace is created by the robot of its node
+    assert namespaces[0]['robot'] == 'node1'
+    pool.api.robots.get.assert_called_once_with('node1', 'http://node1:6600')
+
+    # a full pool creates nothing
+    pool._refill()
+    assert pool.api.services.create.call_count == 2
+    assert len(pool.data['workloads']) == 4
+
+
+def test_refill_failure(monkeypatch):
+    """
+    test that a target stops being refilled at its first failure
+    """
+    monkeypatch.setattr(warm_pool, 'farm_nodes', lambda farm: FarmNodes([]))
+    pool = _pool(targets=[{'type': 'vm', 'size': 1, 'farm': 'freefarm', 'diskType': '', 'mode': '', 'count': 3}])
+    pool._refill()
+    assert not pool.data['workloads']
+    pool.logger.error.assert_called_once()
+
+
+def test_expire():
+    """
+    test that the workloads unclaimed for longer than idleExpiry are removed
+    """
+    pool = _pool([_workload('old', created=0), _workload('new', created=float('inf'))])
+    service = pool.api.services.guids.get.return_value
+
+    pool._expire()
+    assert [w['id'] for w in pool.data['workloads']] == ['new']
+    pool.api.services.guids.get.assert_called_once_with('old')
+    service.schedule_action.assert_called_once_with('uninstall')
+    service.delete.assert_called_once_with()
+
+
+def test_claim_expired():
+    """
+    test that a workload past idleExpiry is not claimed
+    """
+    pool = _pool([_workload('old', created=0), _workload('new')])
+
+    assert pool.claim('vm', 1, 'freefarm')['id'] == 'new'
+    assert pool.claim('vm', 1, 'freefarm') is None
+    assert [w['id'] for w in pool.data['workloads']] == ['old']
+
+
+def test_expire_claimed():
+    """
+    test that a workload claimed while another one is being removed is skipped
+    """
+    workloads = [_workload('a', created=0), _workload('b', created=0)]
+    pool = _pool(workloads)
+    removed = []
+
+    def remove(workload):
+        # a claim runs while the removal yields
+        removed.append(workload['id'])
+        if workload['id'] == 'a':
+            pool.data['workloads'].remove(workloads[1])
+    pool._remove = remove
+
+    pool._expire()
+    assert removed == ['a']
+    assert pool.data['workloads'] == []